@@ -4,43 +4,290 @@
 # Date: 6/5/2017
 #
 #################################################################
+import os
+import json
+import mmap
+import argparse
+import itertools
+import multiprocessing
+
+import numpy as np
 import pandas as pd
 import talib as tl
 
 # Creates price, volume, technical indicators and time related
-# features for input to the prediction models. 
+# features for input to the prediction models.
 # Change filename to create a data set for a different instrument
-# as required.
+# as required, or give the OHLCV files (or directories of them) of
+# any number of instruments on the command line to build them all
+# into an indicator store.
 #
 filename = 'DAX30.csv'
-price_data=pd.read_csv(filename, sep=',',header=0)
 
-np_price_data = price_data.ix[:,1:].values
-open = np_price_data[:,0]
-high = np_price_data[:,1]
-low = np_price_data[:,2]
-close = np_price_data[:,3]
+#################################################################
+#
+# Add the time related and indicator features to price_data, a
+# frame of date, open, high, low, close and volume
+# Return price_data
+#
+def createIndicators(price_data):
+    np_price_data = price_data.iloc[:,1:].values
+    open = np_price_data[:,0]
+    high = np_price_data[:,1]
+    low = np_price_data[:,2]
+    close = np_price_data[:,3]
+
+    # create time related features
+    #
+    price_data['date'] = pd.to_datetime(price_data['date'],infer_datetime_format=True)
+    price_data['DayOfMonth'] =  price_data['date'].dt.day
+    price_data['DayOfWeek'] =  price_data['date'].dt.weekday
+    price_data['WeekOfYear'] = price_data['date'].dt.strftime("%U")
 
-# create time related features
+    # create indicator type features
+    #
+    price_data['dirn'] = (close > open) * 1     # convert to 1/0 value
+    price_data['trend'] = (close > price_data['close'].shift(1)) * 1
+
+    price_data['ma0_trend'] = (price_data['close'] > tl.EMA(close,10)) * 1
+    price_data['ma1_trend'] = (price_data['close'] > tl.EMA(close,20)) * 1
+    price_data['ma2_trend'] = (price_data['close'] > tl.EMA(close,50)) * 1
+    price_data['ma3_trend'] = (price_data['close'] > tl.EMA(close,100)) * 1
+
+    price_data['close_at_high'] = (close == high) * 1
+    price_data['close_at_low'] = (close == low) * 1
+
+    return price_data
+
+# Read OHLCV file filename
+# Return its price data with the time and indicator features added
 #
-price_data['date'] = pd.to_datetime(price_data['date'])
-price_data['DayOfMonth'] =  price_data['date'].dt.day
-price_data['DayOfWeek'] =  price_data['date'].dt.weekday
-price_data['WeekOfYear'] = price_data['date'].dt.strftime("%U")
+def readIndicators(filename):
+    price_data = pd.read_csv(filename, sep=',',header=0)
+    return createIndicators(price_data)
 
-# create indicator type features
+# Return the instrument name of OHLCV file filename, its base name
+# without extension
 #
-price_data['dirn'] = (close > open) * 1     # convert to 1/0 value
-price_data['trend'] = (close > price_data['close'].shift(1)) * 1
+def instrumentName(filename):
+    return os.path.splitext(os.path.basename(filename))[0]
 
-price_data['ma0_trend'] = (price_data['close'] > tl.EMA(close,10)) * 1
-price_data['ma1_trend'] = (price_data['close'] > tl.EMA(close,20)) * 1
-price_data['ma2_trend'] = (price_data['close'] > tl.EMA(close,50)) * 1
-price_data['ma3_trend'] = (price_data['close'] > tl.EMA(close,100)) * 1
+#################################################################
+#
+# Indicator store: the price data and indicators of any number of
+# instruments in one compact binary file, keyed by instrument.
+# Each instrument's columns follow each other as typed arrays -
+# dates as int32 days since 1970 when they are all midnight, else
+# int64 seconds (or nanoseconds if need be), integer columns (the
+# 0/1 flags, day and week numbers, volume) in the smallest integer
+# type that holds them and prices as float64 - and the index of
+# instruments, their columns and where they are comes last, as
+# JSON with its length in the last 8 bytes. IndicatorReader
+# memory-maps the file and reads only the instruments asked for.
+#
+STORE_MAGIC = 'A2IND002'
+STORE_ALIGN = 8
 
-price_data['close_at_high'] = (close == high) * 1
-price_data['close_at_low'] = (close == low) * 1
+# Return the typed array of a column of price data, and the unit
+# of its dates ('D', 's' or 'ns', the coarsest that keeps every
+# value exactly) or None if it is not a date
+#
+def storeColumn(column):
+    if column.dtype.kind == 'M':
+        values = column.values
+        for unit, t in (('D',np.int32),('s',np.int64)):
+            coarse = values.astype('datetime64['+unit+']')
+            if (coarse == values).all():
+                return coarse.astype(t),unit
+        return values.astype('datetime64[ns]').astype(np.int64),'ns'
+    if column.dtype == object:
+        column = pd.to_numeric(column)      # e.g. WeekOfYear strings
+    values = column.values
+    if values.dtype.kind in 'iub':
+        for t in (np.int8,np.int16,np.int32):
+            info = np.iinfo(t)
+            if len(values) == 0 or (values.min() >= info.min and values.max() <= info.max):
+                return values.astype(t),None
+        return values.astype(np.int64),None
+    return values.astype(np.float64),None
 
-# write out the combined price data, time info and technical indicators
+# Return list of (name, typed array, date unit) of the columns of
+# price data
 #
-price_data.to_csv("price_data.csv", index=False, encoding='utf-8')
\ No newline at end of file
+def storeColumns(price_data):
+    columns = []
+    for name in price_data.columns:
+        values, unit = storeColumn(price_data[name])
+        columns.append((name,values,unit))
+    return columns
+
+class IndicatorWriter(object):
+    # Start writing indicator store filename, which replaces any
+    # existing one when closed
+    def __init__(self,filename):
+        self.filename = filename
+        self.f = open(filename + '.tmp','wb')
+        self.f.write(STORE_MAGIC)
+        self.offset = len(STORE_MAGIC)
+        self.index = {}
+
+    # Write the price data of instrument
+    def write(self,instrument,price_data):
+        self.writeColumns(instrument,len(price_data),storeColumns(price_data))
+
+    # Write the rows of instrument as list of (name, typed array,
+    # date unit) columns, see storeColumns
+    def writeColumns(self,instrument,rows,columns):
+        if instrument in self.index:
+            raise ValueError("Instrument "+instrument+" written twice to "+self.filename)
+        entry = {'rows': rows, 'columns': [], 'arrays': {}}
+        for name, values, unit in columns:
+            data = np.ascontiguousarray(values).tostring()
+            entry['columns'].append(name)
+            entry['arrays'][name] = {'dtype': values.dtype.str, 'offset': self.offset,
+                                     'date': unit}
+            padding = -len(data) % STORE_ALIGN
+            self.f.write(data)
+            self.f.write('\0' * padding)
+            self.offset += len(data) + padding
+        self.index[instrument] = entry
+
+    # Write the index and replace filename with the new store
+    def close(self):
+        text = json.dumps(self.index,sort_keys=True)
+        self.f.write(text)
+        self.f.write(np.array([len(text)],dtype='<u8').tostring())
+        self.f.close()
+        try:
+            os.rename(self.filename + '.tmp',self.filename)
+        except OSError:
+            # Windows will not rename over an existing file
+            os.remove(self.filename)
+            os.rename(self.filename + '.tmp',self.filename)
+
+class IndicatorReader(object):
+    def __init__(self,filename):
+        f = open(filename,'rb')
+        try:
+            self.mm = mmap.mmap(f.fileno(),0,access=mmap.ACCESS_READ)
+        finally:
+            f.close()
+        if self.mm[:len(STORE_MAGIC)] != STORE_MAGIC:
+            raise ValueError(filename+" is not an indicator store")
+        size = int(np.frombuffer(self.mm,dtype='<u8',count=1,offset=len(self.mm)-8)[0])
+        self.index = json.loads(self.mm[len(self.mm)-8-size:len(self.mm)-8])
+
+    # Return the sorted list of instruments in the store
+    def instruments(self):
+        return sorted(self.index)
+
+    # Return the price data of instrument
+    def read(self,instrument):
+        entry = self.index[instrument]
+        data = pd.DataFrame()
+        for name in entry['columns']:
+            spec = entry['arrays'][name]
+            values = np.frombuffer(self.mm,dtype=spec['dtype'],count=entry['rows'],
+                                   offset=spec['offset'])
+            if spec['date']:
+                values = values.astype('datetime64['+spec['date']+']')
+            data[name] = values
+        return data
+
+#################################################################
+#
+# Batch build of the indicator store of many instruments. The OHLCV
+# files are read and their indicators created in a pool of worker
+# processes, which send back the typed columns, and written to the
+# store as they finish. A file that cannot be read is reported and
+# skipped rather than stopping the batch.
+#
+# Return the sorted list of OHLCV files of paths, each a file or a
+# directory of .csv files
+#
+def instrumentFiles(paths):
+    files = []
+    for path in paths:
+        if os.path.isdir(path):
+            files.extend(os.path.join(path,name) for name in os.listdir(path)
+                         if name.lower().endswith('.csv'))
+        else:
+            files.append(path)
+    return sorted(files)
+
+# Create the indicators of OHLCV file filename
+# Return tuple of instrument name, number of rows and typed columns
+# (see storeColumns), or the error message and None if the file
+# could not be read
+#
+def buildInstrument(filename):
+    instrument = instrumentName(filename)
+    try:
+        price_data = readIndicators(filename)
+    except Exception as e:
+        return instrument,str(e),None
+    return instrument,len(price_data),storeColumns(price_data)
+
+# Create the indicators of each OHLCV file of paths and write them
+# to indicator store storeFile, with workers processes (0 for one
+# per CPU)
+# Return the number of instruments written
+#
+def buildIndicatorStore(paths,storeFile,workers=0):
+    files = instrumentFiles(paths)
+    names = [instrumentName(f) for f in files]
+    duplicates = sorted(set(n for n in names if names.count(n) > 1))
+    if duplicates:
+        raise ValueError("More than one file for instrument "+", ".join(duplicates))
+    if workers <= 0:
+        workers = multiprocessing.cpu_count()
+
+    pool = None
+    if workers > 1 and len(files) > 1:
+        pool = multiprocessing.Pool(workers)
+        chunksize = max(1,len(files) // (workers * 4))
+        results = pool.imap_unordered(buildInstrument,files,chunksize)
+    else:
+        results = itertools.imap(buildInstrument,files)
+
+    writer = IndicatorWriter(storeFile)
+    count = 0
+    try:
+        for instrument, rows, columns in results:
+            if columns is None:
+                print "Skipped",instrument,":",rows
+                continue
+            writer.writeColumns(instrument,rows,columns)
+            count += 1
+    finally:
+        if pool is not None:
+            pool.close()
+            pool.join()
+    writer.close()
+    print "Wrote",count,"instruments to",storeFile
+    return count
+
+#################################################################
+#
+# With no files given, create the indicators of filename and write
+# them to price_data.csv as before. Otherwise build the indicator
+# store of the given OHLCV files and directories.
+#
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Create price data indicators')
+    parser.add_argument('paths',nargs='*',
+                        help='OHLCV files or directories of them (default '+filename+' to price_data.csv)')
+    parser.add_argument('-o','--output',default='indicators.a2i',
+                        help='indicator store to write (default indicators.a2i)')
+    parser.add_argument('-w','--workers',type=int,default=0,
+                        help='number of worker processes, 0 for one per CPU (default 0)')
+    args = parser.parse_args()
+
+    if not args.paths:
+        price_data = readIndicators(filename)
+
+        # write out the combined price data, time info and technical indicators
+        #
+        price_data.to_csv("price_data.csv", index=False, encoding='utf-8')
+    else:
+        buildIndicatorStore(args.paths,args.output,args.workers)
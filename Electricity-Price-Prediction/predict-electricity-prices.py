@@ -2,7 +2,22 @@ import pandas as pd
 import numpy as np
 import datetime as dt
 import math
+import re
+import sys
+import csv
+import time
+import os
+import json
+import mmap
+import hashlib
+import collections
+import argparse
+import multiprocessing
+import tempfile
+import shutil
+import platform
 
+import sklearn
 from sklearn import metrics
 from sklearn.preprocessing import StandardScaler
 from sklearn.svm import SVR
@@ -11,16 +26,25 @@ from sklearn.ensemble import GradientBoostingRegressor
 from sklearn.ensemble import RandomForestRegressor
 from sklearn.neural_network import MLPRegressor
 
+try:
+    import resource
+except ImportError:
+    resource = None
+
 
 #################################################################
 #
 # Features used in training / prediction
+# (see the feature engine below for the naming of computed features)
 #
-Features =  ['Slot', 'EA', 'EA2', 'WD1', 'EP2-SHIFT-7D'
-             # 'LOAD-SHIFT-1D',           # Decided to remove these after
-             # 'LOAD-SHIFT-7D',           # completed document - not adding to accuracy.
+Features =  ['Slot', 'EA', 'EA2', 'WD1', 'EP2@-7D'
+             # 'LOAD@-1D',                # Decided to remove these after
+             # 'LOAD@-7D',                # completed document - not adding to accuracy.
              ]
 
+# shift all 48 of tomorrows price to today as response variable
+Target = 'EP2@+1D'
+
 #################################################################
 #
 # define model names
@@ -31,14 +55,78 @@ RANDOM_FOREST      = 3
 GRADIENT_BOOSTED   = 4
 EXTRA_TREE_REG     = 5
 
+# the average of the models' forecasts when evaluating several
+ENSEMBLE           = 0
+
+MODEL_LABELS = {SUPPORT_VECTOR_REG: 'SVR',
+                MLP_REGRESSOR:      'MLP',
+                RANDOM_FOREST:      'RandomForest',
+                GRADIENT_BOOSTED:   'GradientBoosted',
+                EXTRA_TREE_REG:     'ExtraTrees',
+                ENSEMBLE:           'Ensemble'}
+
+#################################################################
+#
+# Price data with a sorted date index. Rows are kept in date order
+# so each date's rows are contiguous: dayOffsets[i] is the first
+# row of date dayKeys[i] and dayOffsets[-1] the number of rows.
+# A window of days is then found by binary search and is a slice
+# of the rows. The Features columns, response and slots are
+# extracted once into contiguous arrays, so window slices of them
+# are views with no mask and no copy.
+#
+# The data is held as an ordered dict of column arrays, which may
+# be mapped from the cache along with the extracted arrays (see
+# readPriceCache), and a data frame of the columns is only made
+# when asked for by table().
+#
+class PriceData(object):
+    # columns is an ordered dict of column name to array, arrays
+    # the features, response and slots arrays if already extracted
+    # from the columns in date order
+    def __init__(self,columns,arrays=None):
+        dates = columns['TheDate']
+        if len(dates) > 1 and (dates[1:] < dates[:-1]).any():
+            order = np.argsort(dates,kind='mergesort')
+            columns = collections.OrderedDict((name,a[order]) for name, a
+                                              in columns.iteritems())
+            dates = columns['TheDate']
+            arrays = None
+        self.columns = columns
+        self.frame = None
+        starts = np.flatnonzero(np.r_[True,dates[1:] != dates[:-1]])
+        self.dayKeys = dates[starts]
+        self.dayOffsets = np.append(starts,len(dates))
+        if arrays is None:
+            arrays = (np.column_stack([columns[name] for name in Features]).astype(np.float64),
+                      columns[Target].astype(np.float64),
+                      np.ascontiguousarray(columns['Slot']))
+        self.features, self.response, self.slots = arrays
+
+    def __len__(self):
+        return len(self.slots)
+
+    # Return the data frame of the columns
+    def table(self):
+        if self.frame is None:
+            self.frame = pd.DataFrame(self.columns)
+        return self.frame
+
+    # Return the first and last+1 rows of the days from startDate
+    # to endDate inclusive
+    def window(self,startDate,endDate):
+        dtype = self.dayKeys.dtype
+        i = self.dayKeys.searchsorted(np.datetime64(startDate).astype(dtype),'left')
+        j = self.dayKeys.searchsorted(np.datetime64(endDate).astype(dtype),'right')
+        return self.dayOffsets[i],self.dayOffsets[j]
+
 #################################################################
 #
 # Retrieve historical price data
 #
 def historicalData(data,startDate,endDate):
-    theDate = (data['TheDate'] >= startDate) & (data['TheDate'] <= endDate)
-    a = data[theDate]
-    return(a)
+    lo, hi = data.window(startDate,endDate)
+    return data.table().iloc[lo:hi]
 
 #################################################################
 #
@@ -57,31 +145,355 @@ def mape(actual, pred):
 def rmse(actual, pred):
     return(metrics.mean_squared_error(actual, pred)**0.5)
 
+# Return values with any log or ln transform in settings undone
+#
+def inverseTransform(values,settings):
+    values = np.asarray(values,dtype=np.float64)
+    if settings['doLogTransform'] == True:
+        return np.power(10.0,values)
+    elif settings['doLnTransform'] == True:
+        return np.exp(values)
+    return values
+
 #################################################################
 #
-# Read in data set and create some additional features
+# Streaming forecast error metrics. ErrorSums keeps running sums of
+# the errors of a set of forecasts, from which RMSE, MAPE (as in
+# mape above, relative to the average actual), MAE and bias are
+# each O(1) to report. ForecastMetrics keeps ErrorSums for the
+# latest prediction day and for the whole run, plus the sums of the
+# daily RMSE and MAPE, so adding a day costs only that day's slots.
+#
+class ErrorSums(object):
+    def __init__(self):
+        self.n = 0
+        self.sumActual = 0.0
+        self.sumError = 0.0
+        self.sumAbsError = 0.0
+        self.sumAbsErrorNonZero = 0.0
+        self.sumSqError = 0.0
+
+    # Add the arrays of actual and predicted values
+    def add(self,actual,pred):
+        error = actual - pred
+        absError = np.abs(error)
+        self.n += len(actual)
+        self.sumActual += actual.sum()
+        self.sumError += error.sum()
+        self.sumAbsError += absError.sum()
+        self.sumAbsErrorNonZero += absError[actual != 0].sum()
+        self.sumSqError += np.dot(error,error)
+
+    # Add the sums of other
+    def merge(self,other):
+        self.n += other.n
+        self.sumActual += other.sumActual
+        self.sumError += other.sumError
+        self.sumAbsError += other.sumAbsError
+        self.sumAbsErrorNonZero += other.sumAbsErrorNonZero
+        self.sumSqError += other.sumSqError
+
+    def rmse(self):
+        return math.sqrt(self.sumSqError / self.n)
+
+    # note: we use average actual for denominator to handle
+    # near zero price values in data set
+    def mape(self):
+        return self.sumAbsErrorNonZero / self.sumActual * 100
+
+    def mae(self):
+        return self.sumAbsError / self.n
+
+    def bias(self):
+        return self.sumError / self.n
+
+class ForecastMetrics(object):
+    def __init__(self,settings):
+        self.settings = settings
+        self.day = None
+        self.total = ErrorSums()
+        self.days = 0
+        self.sumDayRmse = 0.0
+        self.sumDayMape = 0.0
+
+    # Add a prediction day's actual and predicted values, still
+    # transformed as in settings
+    def addDay(self,actual,pred):
+        day = ErrorSums()
+        day.add(inverseTransform(actual,self.settings),
+                inverseTransform(pred,self.settings))
+        if day.n == 0:
+            return
+        self.day = day
+        self.total.merge(day)
+        self.days += 1
+        self.sumDayRmse += day.rmse()
+        self.sumDayMape += day.mape()
+
+    # Return the average of the daily RMSE and MAPE
+    def meanDayRmse(self):
+        return self.sumDayRmse / self.days
+
+    def meanDayMape(self):
+        return self.sumDayMape / self.days
+
+#################################################################
+#
+# Feature engine. Features and the Target are named by the column
+# of the price data file they are computed from, followed by any
+# operations and then any time shift:
+#
+#   EA                      column EA as it is
+#   EP2@-7D                 EP2 7 days earlier
+#   EP2@+1D                 EP2 the next day
+#   LOAD@-2H                LOAD 2 hours earlier (shifts are in
+#                           days D, hours H or half hour slots)
+#   LOAD:rollmean(48)       mean of LOAD over the last 48 slots
+#   EP2:diff(48)            change in EP2 since 48 slots earlier
+#   LOAD:rollmean(48)@-1D   that mean, one day earlier
+#
+# Only the columns and features that Features and the Target need
+# are read and built, each over the whole frame at once.
+#
+DATA_FILE = 'price-2014-to-2016.csv'
+
+# date columns always read
+DATE_COLUMNS = ['TheTimeStamp', 'TheDate', 'Slot']
+
+FEATURE_OPERATIONS = {'rollmean': lambda values,n: values.rolling(n).mean(),
+                      'diff':     lambda values,n: values.diff(n)}
+
+SLOTS_PER_UNIT = {'D': 48, 'H': 2, '': 1}
+
+FEATURE_PATTERN = re.compile(r'^([^:@]+)((?::\w+\(\d+\))*)(?:@([+-]\d+)([DH]?))?$')
+OPERATION_PATTERN = re.compile(r':(\w+)\((\d+)\)')
+
+# Parse feature name
+# Return tuple of (column, list of (operation, n), shift in slots)
+#
+def parseFeature(name):
+    match = FEATURE_PATTERN.match(name)
+    if not match:
+        raise ValueError("Bad feature name: "+name)
+    column, operations, lag, unit = match.groups()
+    ops = []
+    for op, n in OPERATION_PATTERN.findall(operations):
+        if op not in FEATURE_OPERATIONS:
+            raise ValueError("Unknown operation "+op+" in feature: "+name)
+        ops.append((op,int(n)))
+    shift = 0
+    if lag:
+        shift = -int(lag) * SLOTS_PER_UNIT[unit]
+    return column,ops,shift
+
+# Return the names of the features in Features and the Target
+#
+def neededFeatures():
+    names = []
+    for name in Features + [Target]:
+        if name not in names:
+            names.append(name)
+    return names
+
+# Return the list of the price data file columns needed by the
+# features names
+#
+def neededColumns(names):
+    columns = list(DATE_COLUMNS)
+    for name in names:
+        column = parseFeature(name)[0]
+        if column not in columns:
+            columns.append(column)
+    return columns
+
+# Return the number of rows before a row that feature name is
+# computed from
+#
+def featureDepth(name):
+    column, ops, shift = parseFeature(name)
+    return max(shift,0) + sum(n for op, n in ops)
+
+# Return the series of feature name computed from frame
+#
+def buildFeature(frame,name):
+    column, ops, shift = parseFeature(name)
+    values = frame[column]
+    for op, n in ops:
+        values = FEATURE_OPERATIONS[op](values,n)
+    if shift:
+        values = values.shift(shift)
+    return values
+
+#################################################################
+#
+# Binary columnar cache of the cleaned, feature engineered price
+# data, kept next to the CSV file as <csv>.cache. The file is a
+# JSON header followed by each column as a typed array - float32
+# values, int32 integers and datetime64 dates - in date order, then
+# the features, response and slots arrays of PriceData. It is
+# memory-mapped on load rather than parsed, and the arrays used
+# are views of the mapped file, not copies. The header records the
+# CSV file's size and modification time and a hash of the feature
+# definitions, and the cache is rebuilt when either changes.
+#
+# The data is held with the cache's column types whether or not it
+# came from the cache, so results do not depend on a cache hit.
+#
+CACHE_MAGIC = 'EPCACHE2'
+CACHE_ALIGN = 64
+CACHE_EXTRACTS = ['features','response','slots']
+
+# Return the hash of the feature definitions the cached data
+# depends on
+#
+def featureKey():
+    return hashlib.md5(repr((CACHE_MAGIC,neededFeatures()))).hexdigest()
+
+# Return the size and modification time of filename
+#
+def fileStamp(filename):
+    st = os.stat(filename)
+    return [st.st_size,st.st_mtime]
+
+# Return the column as a typed array, or None if it is not numeric
+# or a date
+#
+def typedColumn(column):
+    a = column.values
+    if a.dtype.kind == 'M':
+        return a
+    elif a.dtype.kind in 'iub':
+        if len(a) == 0 or (a.min() >= -2**31 and a.max() < 2**31):
+            return a.astype(np.int32)
+        return a.astype(np.int64)
+    elif a.dtype.kind == 'f':
+        return a.astype(np.float32)
+    return None
+
+# Return list of (name, typed array) of the columns of frame
 #
-def initialise_price_data():
-    data=pd.read_csv('price-2014-to-2016.csv', sep=',',header=0, low_memory=False)
+def typedColumns(frame):
+    columns = []
+    for name in frame.columns:
+        a = typedColumn(frame[name])
+        if a is not None:
+            columns.append((name,a))
+    return columns
+
+# Write price data to cache file filename, recording stamp of the
+# CSV file it was read from
+#
+def writePriceCache(filename,data,stamp):
+    arrays = list(data.columns.iteritems())
+    arrays += zip(CACHE_EXTRACTS,(data.features,data.response,data.slots))
+    header = {'stamp': stamp, 'features': featureKey(),
+              'columns': list(data.columns), 'arrays': []}
+    offset = 0
+    for name, a in arrays:
+        header['arrays'].append({'dtype': a.dtype.str,
+                                 'shape': list(a.shape),
+                                 'offset': offset})
+        offset += -(-a.nbytes // CACHE_ALIGN) * CACHE_ALIGN
+    text = json.dumps(header,sort_keys=True)
+    text += ' ' * (-(len(text) + 16) % CACHE_ALIGN)
+    temp = filename + '.tmp'
+    f = open(temp,'wb')
+    f.write(CACHE_MAGIC)
+    f.write(np.array([len(text)],dtype='<u8').tostring())
+    f.write(text)
+    for name, a in arrays:
+        raw = np.ascontiguousarray(a).tostring()
+        f.write(raw)
+        f.write('\0' * (-len(raw) % CACHE_ALIGN))
+    f.close()
+    try:
+        os.rename(temp,filename)
+    except OSError:
+        # Windows will not rename over an existing file
+        os.remove(filename)
+        os.rename(temp,filename)
+
+# Memory-map cache file filename
+# Return the price data, its arrays read-only views of the mapped
+# file, or None if the file is missing or is not for stamp of the
+# CSV file and the current features
+#
+def readPriceCache(filename,stamp):
+    if not os.path.exists(filename):
+        return None
+    f = open(filename,'rb')
+    try:
+        mm = mmap.mmap(f.fileno(),0,access=mmap.ACCESS_READ)
+    finally:
+        f.close()
+    if mm[:8] != CACHE_MAGIC:
+        return None
+    size = int(np.frombuffer(mm,dtype='<u8',count=1,offset=8)[0])
+    header = json.loads(mm[16:16+size])
+    if header['stamp'] != stamp or header['features'] != featureKey():
+        return None
+    base = 16 + size
+    arrays = []
+    for spec in header['arrays']:
+        shape = tuple(spec['shape'])
+        a = np.frombuffer(mm,dtype=spec['dtype'],
+                          count=int(np.prod(shape)),
+                          offset=base+spec['offset'])
+        arrays.append(a.reshape(shape))
+    n = len(header['columns'])
+    columns = collections.OrderedDict(zip(header['columns'],arrays[:n]))
+    return PriceData(columns,tuple(arrays[n:]))
+
+#################################################################
+#
+# Read in data set and create the features in use
+#
+def readPriceCsv():
+    names = neededFeatures()
+    columns = neededColumns(names)
+    header = pd.read_csv(DATA_FILE, sep=',',header=0, nrows=0).columns
+    missing = [column for column in columns if column not in header]
+    if missing:
+        raise ValueError(DATA_FILE+" has no column "+", ".join(missing))
+    data=pd.read_csv(DATA_FILE, sep=',',header=0, low_memory=False,
+                     usecols=columns)
 
     # convert date/time related to correct type
     data['TheTimeStamp'] = pd.to_datetime(data['TheTimeStamp'])
     data['TheDate'] = pd.to_datetime(data['TheDate'])
 
-    # create time shifted features
-    data['LOAD-SHIFT-1D'] = data['LOAD'].shift(48)
-    data['LOAD-SHIFT-7D'] = data['LOAD'].shift(48*7)
-    data['diff_log10_EP2-SHIFT-7D'] = data['diff_log10_EP2'].shift(48*7)
-    data['EP2-SHIFT-7D'] = data['EP2'].shift(48 * 7)
-
-    # shift all 48 of tomorrows price to today as response variable
-    data['EP2-SHIFT-1D'] = data['EP2'].shift(-48)
+    # create the computed features
+    for name in names:
+        if name not in data:
+            data[name] = buildFeature(data,name)
+    data.drop([column for column in data.columns
+               if column not in DATE_COLUMNS and column not in names],
+              axis=1, inplace=True)
 
     data.replace(r'\s+( +\.)|#', np.nan, regex=True).replace('', np.nan)
     data.dropna(inplace=True) # delete rows with any cell Nan
 
     return data
 
+# Return the price data, from the cache if it is up to date, else
+# read from the CSV file and cached
+#
+def initialise_price_data(useCache=True):
+    cacheFile = DATA_FILE + '.cache'
+    stamp = fileStamp(DATA_FILE)
+    if useCache:
+        data = readPriceCache(cacheFile,stamp)
+        if data is not None:
+            return data
+
+    data = PriceData(collections.OrderedDict(typedColumns(readPriceCsv())))
+    if useCache:
+        try:
+            writePriceCache(cacheFile,data,stamp)
+        except (IOError,OSError) as e:
+            print "Could not write price data cache",cacheFile,":",e
+    return data
+
 #################################################################
 #
 # Creates the required model
@@ -106,14 +518,898 @@ def createModel(modelName):
 
 #################################################################
 #
-# Main routine
+# Walk-forward backtest. Each prediction day trains a new model
+# on the trainingDays before it and predicts its 48 slots, so the
+# days are independent and can be run in a pool of worker
+# processes. The random seed is reset before every fit, so a day's
+# forecast is the same whichever process runs it and in whatever
+# order.
+#
+SEED = 666
+
+backtestData = None
+backtestSettings = None
+
+# Set the price data and settings used by backtestDay and
+# backtestSliding, in this process or in a worker process of the
+# pool
+#
+def initBacktest(data,settings):
+    global backtestData, backtestSettings
+    backtestData = data
+    backtestSettings = settings
+
+# Return the response values of rows lo to hi of data, transformed
+# if specified in settings
+#
+def responseValues(data,lo,hi,settings):
+    return transformValues(data.response[lo:hi],settings)
+
+# Return array of response values transformed if specified in
+# settings
+#
+def transformValues(values,settings):
+    if settings['doLogTransform'] == True:
+        return np.log10(values)
+    elif settings['doLnTransform'] == True:
+        return np.log(values)
+    else:
+        return values
+
+# Predict the day after training window ending endDate with the
+# trained scaler and each of models, a dict of trained model by
+# model name, adding the test date and, if there was test data, the
+# day's slots, actual values and each model's predicted values to
+# result
+#
+def predictDay(data,settings,result,endDate,scaler,models):
+    if RANDOM_FOREST in models:
+        result['importances'] = models[RANDOM_FOREST].feature_importances_
+
+    # now that we've trained the models we predict value for
+    # the next day after the last training day
+    testStartDate = endDate + dt.timedelta(days=1)
+    testEndDate = testStartDate + dt.timedelta(days=0)
+    result['testStartDate'] = testStartDate
+    lo, hi = data.window(testStartDate, testEndDate)
+    if hi > lo:
+        testX = scaler.transform(data.features[lo:hi])
+        testY = responseValues(data,lo,hi,settings)
+
+        result['slots'] = data.slots[lo:hi].tolist()
+        result['testValues'] = testY.tolist()
+        result['predictions'] = {}
+        for modelName, model in models.iteritems():
+            result['predictions'][modelName] = model.predict(testX).tolist()
+
+# Return dict of the training window of prediction day theDay
 #
-def main():
+def dayResult(theDay,settings):
+    startDate = settings['trainStartDate'] + dt.timedelta(days=theDay)
+    endDate = startDate +  dt.timedelta(days=settings['trainingDays'])
+    return {'day':theDay, 'startDate':startDate, 'endDate':endDate}
+
+# Train and predict prediction day theDay with each of the models
+# in settings. The window is sliced and scaled once and shared by
+# all of them, and the seed is reset before each model is fitted,
+# so a model's forecast does not depend on what else is evaluated.
+# Return dict of the training window, the test date and, if there
+# was training data, each model's fit time and the random forest's
+# feature importances and, if there was test data, the day's slots,
+# actual values and each model's predicted values
+#
+def backtestDay(theDay):
+    data = backtestData
+    settings = backtestSettings
+    result = dayResult(theDay,settings)
+
+    lo, hi = data.window(result['startDate'], result['endDate'])
+    trainX = data.features[lo:hi]
+
+    if len(trainX) > 0:
+        trainY = responseValues(data,lo,hi,settings)
+
+        scaler = StandardScaler().fit(trainX)
+        trainX = scaler.transform(trainX)
+
+        models = {}
+        result['fitTimes'] = {}
+        for modelName in settings['modelNames']:
+            np.random.seed(SEED)
+
+            start = time.time()
+            model = createModel(modelName)
+            model.fit(trainX, trainY)
+            result['fitTimes'][modelName] = time.time() - start
+            models[modelName] = model
+
+        predictDay(data,settings,result,result['endDate'],scaler,models)
+
+    return result
+
+# Train and predict each of a list of prediction days
+# Return list of results, see backtestDay
+#
+def backtestDays(days):
+    return [backtestDay(theDay) for theDay in days]
+
+#################################################################
+#
+# Sliding window training. Consecutive training windows differ by
+# only the day added and the day expired, so rather than refit from
+# scratch every day the scaler's sums are updated by those days,
+# and a model that supports it continues from the previous day's
+# state doing about WARM_FRACTION of the work of a full fit:
+#
+#   GradientBoostingRegressor   adds that fraction of its boosting
+#                               stages, fitted on the new window
+#   RandomForest/ExtraTrees     replace that fraction of their
+#                               trees, oldest first, with trees
+#                               fitted on the new window
+#   MLPRegressor                runs that fraction of the epochs of
+#                               its last full fit
+#   SVR                         is refit as before
+#
+# Every refitDays days the scaler and model are refit from scratch
+# to bound drift. The days in between depend only on the ones
+# before them since the refit, so each run of refitDays days can
+# be given to a different worker.
+#
+WARM_FRACTION = 0.1
+
+# Return the number of stages, trees or epochs of a warm update of
+# a model of full size n
+#
+def warmCount(n):
+    return max(1,int(round(n * WARM_FRACTION)))
+
+# Standard scaler of a window of rows of the feature array, kept as
+# sums of the rows and of their squares (offset by the mean of the
+# window it was fitted to, for precision) so it can slide along
+#
+class RollingScaler(object):
+    # Fit to rows lo to hi of features
+    def fit(self,features,lo,hi):
+        X = features[lo:hi]
+        self.offset = X.mean(axis=0)
+        self.n = 0
+        self.sum = np.zeros(X.shape[1])
+        self.sumSq = np.zeros(X.shape[1])
+        self.update(X,1)
+        self.lo, self.hi = lo, hi
+        return self
+
+    # Add (sign 1) or remove (sign -1) rows X
+    def update(self,X,sign):
+        D = X - self.offset
+        self.n += sign * len(X)
+        self.sum += sign * D.sum(axis=0)
+        self.sumSq += sign * np.einsum('ij,ij->j',D,D)
+
+    # Move to rows lo to hi of features, removing the expired rows
+    # and adding the new ones, or refitting if they do not overlap
+    def slide(self,features,lo,hi):
+        if lo < self.lo or hi < self.hi or lo >= self.hi:
+            return self.fit(features,lo,hi)
+        self.update(features[self.lo:lo],-1)
+        self.update(features[self.hi:hi],1)
+        self.lo, self.hi = lo, hi
+        return self
+
+    # Return rows X scaled to zero mean and unit variance
+    def transform(self,X):
+        mean = self.sum / self.n
+        scale = np.sqrt(np.maximum(self.sumSq / self.n - mean * mean,0.0))
+        scale[scale == 0] = 1.0
+        return (X - self.offset - mean) / scale
+
+# Model trained on a sliding window of the price data
+#
+class SlidingModel(object):
+    def __init__(self,modelName):
+        self.modelName = modelName
+        self.model = None
+        self.fullSize = 0
+
+    # Fit a new model to scaled window trainX
+    def refit(self,trainX,trainY):
+        self.model = createModel(self.modelName)
+        self.model.fit(trainX,trainY)
+        if isinstance(self.model,MLPRegressor):
+            self.fullSize = self.model.n_iter_
+        elif hasattr(self.model,'n_estimators'):
+            self.fullSize = self.model.n_estimators
 
-    rSum = []
-    mSum = []
+    # Update the model to scaled window trainX
+    def slide(self,trainX,trainY):
+        model = self.model
+        if isinstance(model,GradientBoostingRegressor):
+            model.warm_start = True
+            model.n_estimators += warmCount(self.fullSize)
+            model.fit(trainX,trainY)
+        elif isinstance(model,(RandomForestRegressor,ExtraTreesRegressor)):
+            k = warmCount(self.fullSize)
+            model.warm_start = True
+            model.n_estimators = len(model.estimators_) + k
+            model.fit(trainX,trainY)
+            del model.estimators_[:k]
+            model.n_estimators = len(model.estimators_)
+        elif isinstance(model,MLPRegressor):
+            for i in range(warmCount(self.fullSize)):
+                model.partial_fit(trainX,trainY)
+        else:
+            model.fit(trainX,trainY)
+
+# Train and predict a run of consecutive prediction days with each
+# of the models in settings, fully fitting on the first and sliding
+# the window for the rest. The scaler is shared by all the models.
+# Return list of results, see backtestDay
+#
+def backtestSliding(days):
+    data = backtestData
+    settings = backtestSettings
+    scaler = RollingScaler()
+    sliding = [SlidingModel(modelName) for modelName in settings['modelNames']]
+    fitted = False
+    results = []
+    for theDay in days:
+        result = dayResult(theDay,settings)
+        lo, hi = data.window(result['startDate'], result['endDate'])
+        if hi > lo:
+            trainY = responseValues(data,lo,hi,settings)
+            if not fitted:
+                scaler.fit(data.features,lo,hi)
+            else:
+                scaler.slide(data.features,lo,hi)
+            trainX = scaler.transform(data.features[lo:hi])
+
+            result['fitTimes'] = {}
+            for s in sliding:
+                start = time.time()
+                if not fitted:
+                    np.random.seed(SEED)
+                    s.refit(trainX,trainY)
+                else:
+                    np.random.seed(SEED + theDay)
+                    s.slide(trainX,trainY)
+                result['fitTimes'][s.modelName] = time.time() - start
+            fitted = True
+
+            models = dict((s.modelName,s.model) for s in sliding)
+            predictDay(data,settings,result,result['endDate'],scaler,models)
+        results.append(result)
+    return results
+
+#################################################################
+#
+# Run the backtest of days, a day at a time or, with refitDays set,
+# in sliding window runs of refitDays days, in a pool of worker
+# processes if more than one. Days in done, a dict of result by
+# day, are not run again but their results are yielded in turn; a
+# sliding window run is only skipped if all of its days are done,
+# as its days depend on the ones before them.
+# Yield the results in day order
+#
+def backtest(data,settings,days,workers=1,done=None):
+    done = done or {}
+    refitDays = settings.get('refitDays',0)
+    if refitDays > 0:
+        func = backtestSliding
+        runs = [days[i:i+refitDays] for i in range(0,len(days),refitDays)]
+    else:
+        func = backtestDays
+        runs = [[theDay] for theDay in days]
+    runs = [run for run in runs
+            if [theDay for theDay in run if theDay not in done]]
+    results = runResults(data,settings,func,runs,workers)
+    for theDay in days:
+        if theDay in done:
+            yield done[theDay]
+            continue
+        for result in results:
+            if result['day'] == theDay:
+                yield result
+                break
+
+# Apply func to each of runs of days, in a pool of worker processes
+# if more than one
+# Yield the results in day order
+#
+def runResults(data,settings,func,runs,workers):
+    if workers <= 1:
+        initBacktest(data,settings)
+        for run in runs:
+            for result in func(run):
+                yield result
+        return
+    pool = multiprocessing.Pool(workers,initBacktest,(data,settings))
+    try:
+        for results in pool.imap(func,runs):
+            for result in results:
+                yield result
+    finally:
+        pool.close()
+        pool.join()
+
+#################################################################
+#
+# Results store, so an interrupted backtest can be resumed. Each
+# day's result - its per-slot forecasts, fit times and metrics - is
+# appended to the store file as a line of JSON as soon as it is
+# merged, and synced to disk. The first line records a key of the
+# backtest's settings, features and price data, and a store is
+# only resumed by a backtest with the same key. On resuming, the
+# days already in the store are not run again but their results
+# are read back in turn, so the cumulative metrics are rebuilt
+# exactly. A last line cut short by the interruption is dropped.
+#
+# Return the key of a backtest with settings
+#
+def backtestKey(settings):
+    key = {'settings': settings, 'features': Features, 'target': Target,
+           'seed': SEED, 'warmFraction': WARM_FRACTION,
+           'data': fileStamp(DATA_FILE)}
+    return hashlib.md5(json.dumps(key,sort_keys=True,default=str)).hexdigest()
+
+# Return the JSON record of a day's result and its metrics, a dict
+# of (RMSE, MAPE) by model name
+#
+def resultRecord(result,dayMetrics):
+    record = {}
+    for name, value in result.iteritems():
+        if isinstance(value,dt.date):
+            value = value.isoformat()
+        elif name == 'importances':
+            value = [float(v) for v in value]
+        elif name == 'predictions':
+            value = dict((modelName,p) for modelName, p in value.iteritems()
+                         if modelName != ENSEMBLE)
+        record[name] = value
+    record['metrics'] = dayMetrics
+    return record
+
+# Return the day's result of JSON record
+#
+def recordResult(record):
+    result = {}
+    for name, value in record.iteritems():
+        if name in ('startDate','endDate','testStartDate'):
+            value = dt.datetime.strptime(value,'%Y-%m-%d').date()
+        elif name == 'importances':
+            value = np.array(value)
+        elif name in ('predictions','fitTimes','metrics'):
+            value = dict((int(modelName),v) for modelName, v in value.iteritems())
+        result[name] = value
+    result['resumed'] = True
+    return result
+
+class ResultsStore(object):
+    # Open store filename for a backtest with key, reading any
+    # results already in it
+    def __init__(self,filename,key):
+        self.filename = filename
+        self.results = {}
+        end = 0
+        if os.path.exists(filename):
+            f = open(filename,'rb')
+            try:
+                lines = f.readlines()
+            finally:
+                f.close()
+            for number, line in enumerate(lines):
+                try:
+                    record = json.loads(line)
+                except ValueError:
+                    if number < len(lines) - 1:
+                        raise ValueError("Bad line "+str(number+1)+" in results file "+filename)
+                    break
+                if number == 0:
+                    if record.get('key') != key:
+                        raise ValueError("Results file "+filename+
+                                         " is for a different backtest")
+                else:
+                    self.results[record['day']] = recordResult(record)
+                end += len(line)
+        self.f = open(filename,'ab')
+        self.f.truncate(end)
+        if end == 0:
+            self.write({'key': key})
+
+    # Append JSON record and sync it to disk
+    def write(self,record):
+        self.f.write(json.dumps(record,sort_keys=True,default=str) + '\n')
+        self.f.flush()
+        os.fsync(self.f.fileno())
+
+    # Add a day's result and its metrics, a dict of (RMSE, MAPE) by
+    # model name
+    def add(self,result,dayMetrics):
+        self.write(resultRecord(result,dayMetrics))
+        self.results[result['day']] = result
+
+    def close(self):
+        self.f.close()
+
+#################################################################
+#
+# Live day-ahead forecasting. LiveForecaster keeps the models, the
+# scaler, the training window and a buffer of the latest raw
+# observations in memory. Observations - rows of the price data
+# file's columns, passed to observe() or appended to a followed
+# file - are added as they arrive. When a day's last slot arrives
+# the features of just that day's rows are computed from the
+# buffer, the day before it (whose target is now known) joins the
+# training window and the oldest day leaves it, the scaler's sums
+# and the models are updated as in sliding window training (refit
+# from scratch every refitDays days, or every day if 0), and the
+# forecast of the next day's 48 slots is returned.
+#
+# Features are rounded to float32 as in the price data cache, so a
+# live forecast is the backtest's forecast of the same day.
+#
+SLOTS_PER_DAY = SLOTS_PER_UNIT['D']
+LIVE_POLL_SECONDS = 1.0
+
+# Return the arrays of Features and transformed Target values of
+# the rows of frame of raw observations
+#
+def featureArrays(frame,settings):
+    X = np.column_stack([buildFeature(frame,name).values.astype(np.float32)
+                         for name in Features]).astype(np.float64)
+    y = buildFeature(frame,Target).values.astype(np.float32).astype(np.float64)
+    return X,transformValues(y,settings)
+
+# Return the row of observation, a dict of column values as
+# strings or numbers, with the types of the price data columns
+#
+def observationRow(observation,columns):
+    row = {}
+    for column in columns:
+        value = observation[column]
+        if column in ('TheTimeStamp','TheDate'):
+            row[column] = pd.Timestamp(value)
+        elif column == 'Slot':
+            row[column] = int(value)
+        else:
+            row[column] = float(value) if value not in ('',None) else np.nan
+    return row
+
+class LiveForecaster(object):
+    # Start from history, a frame of the price data file's columns
+    # needed by the features (see readLiveHistory), and forecast
+    # the day after its last day
+    def __init__(self,settings,history):
+        self.settings = settings
+        self.labels = list(settings['modelNames'])
+        if len(self.labels) > 1:
+            self.labels.append(ENSEMBLE)
+        self.windowDays = settings['trainingDays'] + 1
+        self.refitDays = settings.get('refitDays',0)
+        self.keep = max(featureDepth(name) for name in Features) + 3 * SLOTS_PER_DAY
+        self.columns = list(history.columns)
+        self.scaler = RollingScaler()
+        self.models = [SlidingModel(modelName) for modelName in settings['modelNames']]
+        self.window = collections.deque()
+        self.sinceRefit = 0
+        self.updates = 0
+        self.pending = []
+
+        # every day but the last has its target and is a training day
+        X, y = featureArrays(history,settings)
+        dates = history['TheDate'].values
+        starts = np.flatnonzero(np.r_[True,dates[1:] != dates[:-1]])
+        ends = np.append(starts[1:],len(dates))
+        for lo, hi in zip(starts[:-1],ends[:-1])[-self.windowDays:]:
+            self.addDay(X[lo:hi],y[lo:hi])
+        lo = starts[-1]
+        self.current = (pd.Timestamp(dates[lo]),X[lo:],
+                        history['Slot'].values[lo:].tolist())
+        self.raw = history.iloc[-self.keep:].reset_index(drop=True)
+        self.lastStamp = self.raw['TheTimeStamp'].iloc[-1]
+        self.refit()
+        self.forecast = self.predict()
+
+    # Add the rows of a day with known target, but not any with
+    # missing values, to the training window
+    # Return list of (X, y) of the days that leave the window
+    def addDay(self,X,y):
+        valid = ~(np.isnan(X).any(axis=1) | np.isnan(y))
+        self.window.append((X[valid],y[valid]))
+        expired = []
+        while len(self.window) > self.windowDays:
+            expired.append(self.window.popleft())
+        return expired
+
+    # Refit the scaler and models to the training window
+    def refit(self):
+        X = np.concatenate([x for x, y in self.window])
+        y = np.concatenate([y for x, y in self.window])
+        self.scaler.fit(X,0,len(X))
+        trainX = self.scaler.transform(X)
+        for s in self.models:
+            np.random.seed(SEED)
+            s.refit(trainX,y)
+        self.sinceRefit = 1
+
+    # Slide the scaler and models to the training window, with day
+    # added to it and days expired from it
+    def slide(self,added,expired):
+        self.scaler.update(added[0],1)
+        for X, y in expired:
+            self.scaler.update(X,-1)
+        trainX = self.scaler.transform(np.concatenate([x for x, y in self.window]))
+        trainY = np.concatenate([y for x, y in self.window])
+        for s in self.models:
+            np.random.seed(SEED + self.updates)
+            s.slide(trainX,trainY)
+        self.sinceRefit += 1
+
+    # Return the forecast of the day after the current day, a dict
+    # of its date, slots and the predicted prices of each model, or
+    # None if the current day has missing feature values
+    def predict(self):
+        date, X, slots = self.current
+        if len(X) == 0 or np.isnan(X).any():
+            return None
+        testX = self.scaler.transform(X)
+        predictions = {}
+        for s in self.models:
+            predictions[s.modelName] = s.model.predict(testX)
+        if ENSEMBLE in self.labels:
+            predictions[ENSEMBLE] = np.mean([predictions[modelName] for modelName
+                                             in self.settings['modelNames']],axis=0)
+        for label in predictions:
+            predictions[label] = inverseTransform(predictions[label],self.settings)
+        return {'date': date.date() + dt.timedelta(days=1), 'slots': slots,
+                'predictions': predictions}
+
+    # Complete a day of observation rows: compute its features,
+    # train on the day before and forecast the day after
+    # Return the forecast, see predict
+    def completeDay(self,rows):
+        frame = pd.DataFrame(rows,columns=self.columns)
+        self.raw = pd.concat([self.raw,frame],ignore_index=True).iloc[-self.keep:]
+        X, y = featureArrays(self.raw,self.settings)
+        n = len(frame)
+        m = len(self.current[1])
+
+        added = (self.current[1],y[-(n+m):-n])
+        expired = self.addDay(*added)
+        self.updates += 1
+        if self.refitDays <= 0 or self.sinceRefit >= self.refitDays:
+            self.refit()
+        else:
+            self.slide(self.window[-1],expired)
+
+        self.current = (frame['TheDate'].iloc[0],X[-n:],frame['Slot'].tolist())
+        self.forecast = self.predict()
+        return self.forecast
+
+    # Add observation, a dict of column values
+    # Return the forecast of the next day if observation completes
+    # the current one, else None
+    def observe(self,observation):
+        row = observationRow(observation,self.columns)
+        if row['TheTimeStamp'] <= self.lastStamp:
+            return None
+        self.lastStamp = row['TheTimeStamp']
+        forecast = None
+        if self.pending and row['TheDate'] != self.pending[0]['TheDate']:
+            # a day cut short
+            forecast = self.completeDay(self.pending)
+            self.pending = []
+        self.pending.append(row)
+        if row['Slot'] >= SLOTS_PER_DAY:
+            forecast = self.completeDay(self.pending)
+            self.pending = []
+        return forecast
+
+# Return the frame of the price data file columns needed by the
+# features for the last days of the file, and a list of the rows of
+# its last day if that is incomplete
+#
+def readLiveHistory(days):
+    data = pd.read_csv(DATA_FILE, sep=',',header=0, low_memory=False,
+                       usecols=neededColumns(neededFeatures()))
+    data['TheTimeStamp'] = pd.to_datetime(data['TheTimeStamp'])
+    data['TheDate'] = pd.to_datetime(data['TheDate'])
+    dates = data['TheDate'].unique()
+    data = data[data['TheDate'] >= dates[max(len(dates)-days,0)]]
+    last = data['TheDate'] == dates[-1]
+    if last.sum() >= SLOTS_PER_DAY:
+        return data.reset_index(drop=True),[]
+    pending = data[last].to_dict('records')
+    return data[~last].reset_index(drop=True),pending
+
+# Yield each row, as a dict of column values, of CSV file filename
+# and of every line appended to it, polling for more every
+# LIVE_POLL_SECONDS
+#
+def followCsv(filename):
+    f = open(filename,'r')
+    header = next(csv.reader([f.readline()]))
+    partial = ''
+    while True:
+        line = f.readline()
+        if not line:
+            time.sleep(LIVE_POLL_SECONDS)
+            continue
+        line = partial + line
+        if not line.endswith('\n'):
+            partial = line
+            continue
+        partial = ''
+        if line.strip():
+            yield dict(zip(header,next(csv.reader([line]))))
+
+# Print forecast, see LiveForecaster.predict, as CSV lines of date,
+# slot and each of labels' predicted prices
+#
+def printForecast(forecast,labels):
+    for i, slot in enumerate(forecast['slots']):
+        print ','.join([forecast['date'].isoformat(),str(slot)] +
+                       ['%.2f' % forecast['predictions'][label][i] for label in labels])
+    sys.stdout.flush()
+
+# Forecast live from the price data file's history and the rows
+# appended to file liveFile (which may be the price data file)
+#
+def liveForecast(settings,liveFile):
+    lagDays = -(-max(featureDepth(name) for name in Features) // SLOTS_PER_DAY)
+    history, pending = readLiveHistory(settings['trainingDays'] + lagDays + 3)
+    forecaster = LiveForecaster(settings,history)
+    print ','.join(['TheDate','Slot'] + [MODEL_LABELS[label] for label in forecaster.labels])
+    for row in pending:
+        forecaster.observe(row)
+    if forecaster.forecast:
+        printForecast(forecaster.forecast,forecaster.labels)
+    for observation in followCsv(liveFile):
+        forecast = forecaster.observe(observation)
+        if forecast:
+            printForecast(forecast,forecaster.labels)
+
+#################################################################
+#
+# Benchmark of the models. Synthetic half hourly price data of each
+# of BENCHMARK_YEARS years is written to a temporary CSV file and
+# timed through loading (CSV parse and feature build, cache write,
+# cache load). Then, for each of BENCHMARK_TRAINING_DAYS, window
+# slicing and scaling are timed on every size of data, and each
+# model's fit, predict and sliding window update on the largest,
+# each model in a new worker process so its peak memory is its own.
+# Results are written as JSON or CSV, by file extension, to compare
+# between versions.
+#
+BENCHMARK_YEARS = [1, 2, 4]
+BENCHMARK_TRAINING_DAYS = [90, 180, 360]
+BENCHMARK_REPEATS = 20              # repeats of the fast measurements
+
+BENCHMARK_FIELDS = ['stage', 'years', 'rows', 'trainingDays', 'model',
+                    'seconds', 'peakMemoryMB', 'memoryGrowthMB']
+
+# Return the peak memory use of this process in MB, or None if not
+# known
+#
+def peakMemoryMB():
+    if resource is None:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    if sys.platform == 'darwin':
+        return peak / 1048576.0
+    return peak / 1024.0
+
+# Return a frame of synthetic half hourly price data with the
+# columns of the price data file, for days days from startDate:
+# load with daily, weekly and yearly cycles, price forecasts EA and
+# EA2 following the load, and price EP2 following them with noise
+# and spikes at high load, all from a fixed seed
+#
+def syntheticPriceData(days,startDate=dt.date(2014,1,1),seed=0):
+    r = np.random.RandomState(seed)
+    n = days * SLOTS_PER_DAY
+    dates = pd.date_range(startDate,periods=days,freq='D')
+    t = np.arange(n) / float(SLOTS_PER_DAY)
+    weekday = np.repeat(dates.weekday < 5,SLOTS_PER_DAY)
+    load = (4000 + 800 * np.sin(2 * np.pi * (t - 0.3))
+            + 600 * np.cos(2 * np.pi * t / 365.25)
+            + 300 * weekday + r.normal(0,80,n))
+    ea = 45 + 0.01 * (load - 4000) + r.normal(0,2,n)
+    ep2 = ea + r.normal(0,3,n) + (load > 5200) * r.exponential(20,n)
+    ep2 = np.maximum(ep2,1.0).round(2)
+    data = collections.OrderedDict()
+    data['TheTimeStamp'] = pd.date_range(startDate,periods=n,freq='30min')
+    data['TheDate'] = np.repeat(dates.values,SLOTS_PER_DAY)
+    data['Slot'] = np.tile(np.arange(1,SLOTS_PER_DAY + 1),days)
+    data['EA'] = ea.round(2)
+    data['EA2'] = (ea + r.normal(0,1.5,n)).round(2)
+    data['WD1'] = weekday.astype(int)
+    data['EP2'] = ep2
+    data['LOAD'] = load.round(1)
+    data['diff_log10_EP2'] = np.r_[0.0,np.diff(np.log10(ep2))].round(5)
+    return pd.DataFrame(data)
+
+# Return the average seconds of BENCHMARK_REPEATS calls of func
+#
+def timeRepeats(func):
+    start = time.time()
+    for i in range(BENCHMARK_REPEATS):
+        func()
+    return (time.time() - start) / BENCHMARK_REPEATS
+
+# Return the rows lo to hi of the last training window of
+# trainingDays days in data, and the rows of the day after it
+#
+def lastWindow(data,trainingDays):
+    lastDate = pd.Timestamp(data.dayKeys[-1]).date()
+    endDate = lastDate - dt.timedelta(days=1)
+    lo, hi = data.window(endDate - dt.timedelta(days=trainingDays),endDate)
+    testLo, testHi = data.window(lastDate,lastDate)
+    return lo,hi,testLo,testHi
+
+# Time the fit, predict and sliding window update of model
+# modelName on the last training window of trainingDays days of
+# the backtest data, in a worker process
+# Return list of benchmark records
+#
+def benchmarkModel(task):
+    modelName, trainingDays, years = task
+    data = backtestData
+    settings = backtestSettings
+    baseline = peakMemoryMB()
+    lo, hi, testLo, testHi = lastWindow(data,trainingDays)
+    scaler = RollingScaler().fit(data.features,lo - SLOTS_PER_DAY,hi - SLOTS_PER_DAY)
+    trainX = scaler.transform(data.features[lo - SLOTS_PER_DAY:hi - SLOTS_PER_DAY])
+    trainY = responseValues(data,lo - SLOTS_PER_DAY,hi - SLOTS_PER_DAY,settings)
+    sliding = SlidingModel(modelName)
+
+    times = []
+    np.random.seed(SEED)
+    start = time.time()
+    sliding.refit(trainX,trainY)
+    times.append(('fit',time.time() - start))
+
+    # slide on a day
+    scaler.slide(data.features,lo,hi)
+    trainX = scaler.transform(data.features[lo:hi])
+    trainY = responseValues(data,lo,hi,settings)
+    np.random.seed(SEED + 1)
+    start = time.time()
+    sliding.slide(trainX,trainY)
+    times.append(('warm update',time.time() - start))
+
+    testX = scaler.transform(data.features[testLo:testHi])
+    times.append(('predict',timeRepeats(lambda: sliding.model.predict(testX))))
+
+    peak = peakMemoryMB()
+    records = []
+    for stage, seconds in times:
+        records.append({'stage': stage, 'years': years, 'rows': len(data),
+                        'trainingDays': trainingDays, 'model': MODEL_LABELS[modelName],
+                        'seconds': seconds, 'peakMemoryMB': peak,
+                        'memoryGrowthMB': peak - baseline if peak is not None else None})
+    return records
+
+# Time loading the synthetic data file of the given years, and the
+# window slicing and scaling of each of BENCHMARK_TRAINING_DAYS
+# Return the price data and list of benchmark records
+#
+def benchmarkData(years,directory):
+    global DATA_FILE
+    records = []
+    def record(stage,seconds,trainingDays=None):
+        records.append({'stage': stage, 'years': years, 'rows': rows,
+                        'trainingDays': trainingDays, 'model': None,
+                        'seconds': seconds, 'peakMemoryMB': peakMemoryMB(),
+                        'memoryGrowthMB': None})
+        days = "%4d days" % trainingDays if trainingDays else ""
+        print "%-14s %d years %9s %10.6f s" % (stage,years,days,seconds)
+
+    filename = os.path.join(directory,'price-%dy.csv' % years)
+    syntheticPriceData(int(years * 365.25)).to_csv(filename,index=False)
+    savedDataFile = DATA_FILE
+    DATA_FILE = filename
+    try:
+        start = time.time()
+        data = initialise_price_data(False)
+        seconds = time.time() - start
+        rows = len(data)
+        record('csv load',seconds)
+
+        start = time.time()
+        writePriceCache(filename + '.cache',data,fileStamp(filename))
+        record('cache write',time.time() - start)
+
+        record('cache load',timeRepeats(lambda: initialise_price_data(True)))
+    finally:
+        DATA_FILE = savedDataFile
+
+    for trainingDays in BENCHMARK_TRAINING_DAYS:
+        lo, hi, testLo, testHi = lastWindow(data,trainingDays)
+        dates = [pd.Timestamp(d).date() for d in data.dayKeys]
+        def sliceWindows():
+            for d in dates[trainingDays:]:
+                lo, hi = data.window(d - dt.timedelta(days=trainingDays),d)
+                data.features[lo:hi]
+        start = time.time()
+        sliceWindows()
+        record('slice',(time.time() - start) / max(len(dates) - trainingDays,1),trainingDays)
+        X = data.features[lo:hi]
+        record('scale',timeRepeats(lambda: StandardScaler().fit(X).transform(X)),trainingDays)
+        # a day's slide of the rolling scaler, adding and removing the
+        # same day so every repeat does the same work
+        scaler = RollingScaler().fit(data.features,lo,hi)
+        newDay = data.features[hi - SLOTS_PER_DAY:hi]
+        def slideScaler():
+            scaler.update(newDay,1)
+            scaler.update(newDay,-1)
+            scaler.transform(X)
+        record('rolling scale',timeRepeats(slideScaler),trainingDays)
+    return data,records
+
+# Write benchmark records to filename, as CSV if it ends .csv else
+# as JSON with details of the versions and machine
+#
+def writeBenchmark(filename,records,settings):
+    if filename.lower().endswith('.csv'):
+        f = open(filename,'wb')
+        writer = csv.DictWriter(f,BENCHMARK_FIELDS)
+        writer.writeheader()
+        writer.writerows(records)
+        f.close()
+        return
+    report = {'created': dt.datetime.now().isoformat(),
+              'python': platform.python_version(),
+              'numpy': np.__version__, 'pandas': pd.__version__,
+              'sklearn': sklearn.__version__,
+              'platform': platform.platform(),
+              'cpus': multiprocessing.cpu_count(),
+              'features': Features, 'target': Target,
+              'years': BENCHMARK_YEARS, 'trainingDays': BENCHMARK_TRAINING_DAYS,
+              'repeats': BENCHMARK_REPEATS,
+              'models': [MODEL_LABELS[m] for m in settings['modelNames']],
+              'results': records}
+    f = open(filename,'w')
+    json.dump(report,f,indent=1,sort_keys=True)
+    f.close()
+
+# Run the benchmark of the models in settings, writing the results
+# to filename
+#
+def benchmark(settings,filename):
+    directory = tempfile.mkdtemp(prefix='price-benchmark-')
+    records = []
+    try:
+        for years in BENCHMARK_YEARS:
+            data, dataRecords = benchmarkData(years,directory)
+            records.extend(dataRecords)
+    finally:
+        shutil.rmtree(directory,ignore_errors=True)
+
+    # fit on the largest data set, a model at a time in a new process
+    years = BENCHMARK_YEARS[-1]
+    for trainingDays in BENCHMARK_TRAINING_DAYS:
+        for modelName in settings['modelNames']:
+            pool = multiprocessing.Pool(1,initBacktest,(data,settings))
+            try:
+                modelRecords = pool.apply(benchmarkModel,((modelName,trainingDays,years),))
+            finally:
+                pool.close()
+                pool.join()
+            for r in modelRecords:
+                print "%-14s %-15s %4d days %10.6f s %8.1f MB" % \
+                    (r['stage'],r['model'],trainingDays,r['seconds'],r['peakMemoryMB'] or 0)
+            records.extend(modelRecords)
+
+    writeBenchmark(filename,records,settings)
+    print "Benchmark results written to",filename
+
+#################################################################
+#
+# Main routine
+#
+def main(workers=1,useCache=True,refitDays=0,modelNames=None,resultsFile=None,
+         liveFile=None,benchmarkFile=None):
 
-    forecast = {}
     doLogTransform = False
     doLnTransform = False
 
@@ -127,109 +1423,185 @@ def main():
     startDay = 1
     nDays = 360                         # number of prediction days
 
-    data = initialise_price_data()
-    model = createModel(modelName)
+    if workers <= 0:
+        workers = multiprocessing.cpu_count()
+
+    # models to evaluate side by side, with their average as the
+    # ensemble forecast
+    if not modelNames:
+        modelNames = [modelName]
+    labels = list(modelNames)
+    if len(modelNames) > 1:
+        labels.append(ENSEMBLE)
 
-    print dt.datetime.now().time(),",",trainingDays
     trainStartDate = testStartDate - dt.timedelta(days=trainingDays + 2)
 
-    for theDay in (range(startDay,startDay+nDays)):
+    settings = {'modelNames':modelNames, 'trainingDays':trainingDays,
+                'trainStartDate':trainStartDate,
+                'doLogTransform':doLogTransform, 'doLnTransform':doLnTransform,
+                'refitDays':refitDays}
 
-        startDate = trainStartDate + dt.timedelta(days=theDay)
-        endDate = startDate +  dt.timedelta(days=trainingDays)
+    if liveFile:
+        liveForecast(settings,liveFile)
+        return
 
-        print dt.datetime.now().time(),"Training data from: ",startDate," to ",endDate
-        df = historicalData(data, startDate, endDate)
+    if benchmarkFile:
+        benchmark(settings,benchmarkFile)
+        return
 
-        trainX = np.array(df[Features].values)
+    data = initialise_price_data(useCache)
 
-        if len(trainX) > 0:
+    print dt.datetime.now().time(),",",trainingDays
+    days = range(startDay,startDay+nDays)
+    accuracy = dict((label,ForecastMetrics(settings)) for label in labels)
+    fitTimes = dict((label,0.0) for label in labels)
 
-            # do transforms if specified
-            if doLogTransform == True:
-                trainY = df["EP2-SHIFT-1D"].apply(math.log10).values
-            elif doLnTransform == True:
-                trainY = df["EP2-SHIFT-1D"].apply(math.log).values
-            else:
-                trainY = df["EP2-SHIFT-1D"].values
+    store = None
+    done = {}
+    if resultsFile:
+        store = ResultsStore(resultsFile,backtestKey(settings))
+        done = store.results
+        if done:
+            print "Resuming from",resultsFile,":",len(done),"days already done"
 
-            scaler = StandardScaler().fit(trainX)
-            trainX = scaler.transform(trainX)
+    for result in backtest(data,settings,days,workers,done):
 
-            np.random.seed(666)
+        print dt.datetime.now().time(),"Training data from: ",result['startDate']," to ",result['endDate']
 
-            model.fit(trainX, trainY)
+        if 'testStartDate' in result:
+            testStartDate = result['testStartDate']
 
-            if modelName == RANDOM_FOREST:
-                for index in range(len(trainX[0])):
-                    importances[index].append(model.feature_importances_[index])
-
-            # now that we've trained the model we predict value for
-            # the next day after the last training day
-            testStartDate = endDate + dt.timedelta(days=1)
-            testEndDate = testStartDate + dt.timedelta(days=0)
-            df = historicalData(data, testStartDate, testEndDate)
-            if len(df) > 0:
-                testX = np.array(df[Features].values)
-                testX = scaler.transform(testX)
-
-                # do transforms if specified
-                if doLogTransform == True:
-                    testY = df["EP2-SHIFT-1D"].apply(math.log10).values
-                elif doLnTransform == True:
-                    testY = df["EP2-SHIFT-1D"].apply(math.log).values
-                else:
-                    testY = df["EP2-SHIFT-1D"].values
-
-                p = model.predict(testX)
-
-                slots = df['Slot'].tolist()
-                testValues = testY.tolist()
-                predictedValues = p.tolist()
-
-                # save the predicted values
-                for s in range(0,len(slots)):
-                    forecast[slots[s]] = {testValues[s]:predictedValues[s]}
-
-        # undo any transforms
-        tY = []
-        p = []
-        sortedKeys = sorted(forecast.keys())
-        for k in sortedKeys:
-            v = forecast[k]
-            if doLogTransform == True:
-                tY.append(math.pow(10,v.keys()[0]))
-                p.append(math.pow(10,v.values()[0]))
-            elif doLnTransform == True:
-                tY.append(math.exp(v.keys()[0]))
-                p.append(math.exp(v.values()[0]))
-            else:
-                tY.append((v.keys()[0]))
-                p.append((v.values()[0]))
+        if 'importances' in result:
+            for index in range(len(Features)):
+                importances[index].append(result['importances'][index])
+
+        for modelName, seconds in result.get('fitTimes',{}).iteritems():
+            fitTimes[modelName] += seconds
+            if ENSEMBLE in fitTimes:
+                fitTimes[ENSEMBLE] += seconds
+
+        if 'slots' not in result:
+            if store and not result.get('resumed'):
+                store.add(result,{})
+            continue
+
+        # the ensemble forecast is the average of the models'
+        # forecasts (transformed, if a transform is specified)
+        predictions = result['predictions']
+        if ENSEMBLE in accuracy:
+            predictions[ENSEMBLE] = np.mean([predictions[modelName]
+                                             for modelName in modelNames],axis=0)
+        for label in labels:
+            accuracy[label].addDay(result['testValues'],predictions[label])
 
         # if we have predicted values print accuracy metrics
-        if len(tY) > 0:
-            r = rmse(tY,p)
-            m = mape(tY,p)
-
-            print "Test data on: ", testStartDate,",", \
-                "RMSE:", float("{0:.2f}".format(r)), \
-                " MAPE:", float("{0:.2f}".format(m)),'\n'
-
-            # save metrics to for average calculation
-            rSum.append(r)
-            mSum.append(m)
-
-    # print average metrics for complete train/predict run
-    if (len(rSum)):
-        print dt.datetime.now().time(),',', \
-            trainingDays,',',\
-            'Overall RMSE: ',float("{0:.2f}".format(sum(rSum)/len(rSum))),',', \
-            'Overall MAPE: ',float("{0:.2f}".format(sum(mSum)/len(mSum)))
-
-    if modelName == RANDOM_FOREST:
-        for index in range(len(trainX[0])):
+        if len(labels) == 1:
+            day = accuracy[labels[0]].day
+            if day is not None:
+                print "Test data on: ", testStartDate,",", \
+                    "RMSE:", float("{0:.2f}".format(day.rmse())), \
+                    " MAPE:", float("{0:.2f}".format(day.mape())),'\n'
+        else:
+            for label in labels:
+                day = accuracy[label].day
+                if day is not None:
+                    print "Test data on: ", testStartDate,",", \
+                        "%-15s" % MODEL_LABELS[label], \
+                        "RMSE:", float("{0:.2f}".format(day.rmse())), \
+                        " MAPE:", float("{0:.2f}".format(day.mape()))
+            print
+
+        if store and not result.get('resumed'):
+            dayMetrics = {}
+            for label in labels:
+                day = accuracy[label].day
+                if day is not None:
+                    dayMetrics[label] = (day.rmse(),day.mape())
+            store.add(result,dayMetrics)
+
+    if store:
+        store.close()
+
+    # print average metrics for complete train/predict run, and the
+    # metrics of all its forecasts together
+    if len(labels) == 1:
+        single = accuracy[labels[0]]
+        if single.days:
+            print dt.datetime.now().time(),',', \
+                trainingDays,',',\
+                'Overall RMSE: ',float("{0:.2f}".format(single.meanDayRmse())),',', \
+                'Overall MAPE: ',float("{0:.2f}".format(single.meanDayMape()))
+            total = single.total
+            print 'All forecasts RMSE: ',float("{0:.2f}".format(total.rmse())),',', \
+                'MAPE: ',float("{0:.2f}".format(total.mape())),',', \
+                'MAE: ',float("{0:.2f}".format(total.mae())),',', \
+                'Bias: ',float("{0:.2f}".format(total.bias()))
+    else:
+        print dt.datetime.now().time(),',',trainingDays
+        print "%-16s %12s %12s %12s %12s %12s" % \
+            ('Model','Overall RMSE','Overall MAPE','All RMSE','All MAPE','Fit time (s)')
+        for label in labels:
+            a = accuracy[label]
+            if a.days:
+                print "%-16s %12.2f %12.2f %12.2f %12.2f %12.1f" % \
+                    (MODEL_LABELS[label],a.meanDayRmse(),a.meanDayMape(),
+                     a.total.rmse(),a.total.mape(),fitTimes[label])
+
+    if RANDOM_FOREST in modelNames:
+        for index in range(len(Features)):
             print "Average importance of feature ", index, "is", \
                 sum(importances[index])/len(importances[index])
 
-main()
\ No newline at end of file
+# Return the list of model names of a comma separated list of
+# model labels (see MODEL_LABELS, in any case), or all of them
+#
+def modelList(text):
+    lookup = dict((label.lower(),modelName) for modelName, label in
+                  MODEL_LABELS.iteritems() if modelName != ENSEMBLE)
+    if text.lower() == 'all':
+        return sorted(lookup.values())
+    modelNames = []
+    for label in text.split(','):
+        label = label.strip().lower()
+        if label not in lookup:
+            raise argparse.ArgumentTypeError("unknown model: "+label)
+        modelNames.append(lookup[label])
+    return modelNames
+
+#################################################################
+#
+# Command line: --workers sets the number of backtest processes,
+# default 1 (serial), 0 for one per CPU. --no-cache reads the CSV
+# file without using or writing the price data cache.
+# --refit-days N trains on a sliding window, refitting from scratch
+# every N days (default 0, refit every day). --models evaluates a
+# list of models side by side on the same windows. --results FILE
+# saves each day's results to FILE as it goes and resumes from it.
+# --live FILE forecasts each next day live, as rows are appended to
+# FILE, instead of backtesting. --benchmark FILE times the models
+# (those set by --models, default all) on synthetic data and
+# writes the results to FILE (.json or .csv).
+#
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Backtest electricity price prediction')
+    parser.add_argument('-w','--workers',type=int,default=1,
+                        help='number of worker processes, 0 for one per CPU (default 1)')
+    parser.add_argument('--no-cache',dest='useCache',action='store_false',
+                        help='do not use or write the price data cache')
+    parser.add_argument('--refit-days',type=int,default=0,
+                        help='train on a sliding window, refitting every N days (default 0, refit every day)')
+    parser.add_argument('-m','--models',type=modelList,default=None,
+                        help='comma separated models to evaluate side by side, of '+
+                        ', '.join(MODEL_LABELS[m] for m in sorted(MODEL_LABELS) if m != ENSEMBLE)+
+                        ', or all (default the model set in main)')
+    parser.add_argument('-r','--results',default=None,
+                        help='results file to save each day to and resume from')
+    parser.add_argument('--live',default=None,metavar='FILE',
+                        help='forecast live from rows appended to FILE (which may be the price data file)')
+    parser.add_argument('--benchmark',default=None,metavar='FILE',
+                        help='benchmark the models on synthetic data, writing the results to FILE (.json or .csv)')
+    args = parser.parse_args()
+    if args.benchmark and not args.models:
+        args.models = modelList('all')
+    main(args.workers,args.useCache,args.refit_days,args.models,args.results,
+         args.live,args.benchmark)
@@ -8,9 +8,47 @@
 ##############################################################
 
 import os
+import sys
 import string
 import math
+import array
+import operator
+import itertools
+import zlib
+import json
+import time
+import csv
+import hashlib
+import marshal
+import zipfile
+import tarfile
+import mmap
+import argparse
+import multiprocessing
+import traceback
+import threading
+import Queue
+import SocketServer
+import socket
+import signal
 import ConfigParser
+import numpy as np
+import scipy.sparse
+
+try:
+    import py7zlib
+except ImportError:
+    py7zlib = None
+
+try:
+    import nltk
+except ImportError:
+    nltk = None
+
+try:
+    import resource
+except ImportError:
+    resource = None
 
 ##############################################################    
 
@@ -20,28 +58,77 @@ config.read("bayes.ini")
 SYMBOLS = '{}()[],.:;+-*/&|<>=~$'  
 DIGITS  = '1234567890'
 negativeWords = ['Not','not','no','No'] 
-stopWords = ""
+stopWords = frozenset()
+LOWERCASE = string.maketrans(string.ascii_uppercase,string.ascii_lowercase)
+
+BOOLEAN_PARAMETERS = ['Lowercase','RemovePunctuation','RemoveDigits',
+                      'StopWords','Negation','Ngrams','SingleOccurrencePerDoc',
+                      'PartOfSpeech','ReduceFeature']
+INTEGER_PARAMETERS = ['NgramSize','ReduceFeatureCount']
+
+# Options added since the original config file, with their defaults
+# (None means use the value of the option named in DEFAULT_FROM)
+OPTIONAL_PARAMETERS = {'NgramMinSize': None, 'NgramHashBits': 0,
+                       'FeatureSelection': 'frequency'}
+DEFAULT_FROM = {'NgramMinSize': 'NgramSize'}
+
+# Ways of ranking the terms kept by ReduceFeature, see featureScores
+FEATURE_SELECTIONS = ['frequency','chi2','mi','logodds']
+
+# Number of documents classified per sparse matrix product
+BATCH_SIZE = 1000
+
+# Number of documents sent to a training worker at a time
+SHARD_SIZE = 200
+
+# Compiled preprocessing pipeline, built on first use from the
+# config Parameters section and the stop words (see getPreprocessor)
+preprocessor = None
+
+# On-disk cache of pre-processed documents, opened on first use
+# (see getTokenCache)
+tokenCache = None
+
+# Part of speech tagger, loaded on first use (see getPosTagger)
+posTagger = None
+
+# Stage profiler of the run, None unless profiling (see startProfiler)
+profiler = None
+
+# Training documents of a parameter sweep and the stage outputs
+# of the last sweep task run in this process (see sweepTask)
+sweepDocs = None
+sweepMemo = {}
 
 ##############################################################
     
 def containsAny(astr, strset):
-    notrans = string.maketrans('', '')
-    return len(strset) != len(strset.translate(notrans, astr))
-
-# Generate space separated ngrams from list of words
-# Return list of ngrams
-#
-def ngrams(n,words):
-    retList = [] 
-    for i in range(len(words)-n+1): 
-        s = ""
-        j = i
-        while j < i + n:
-            s = s + " " + words[j] 
-            j = j + 1
-        retList.append(s[1:]) # remove the leading space
-        i = i + 1
-    return retList
+    return len(strset) != len(strset.translate(None, astr))
+
+# Generate space separated ngrams of every order from minN up to n
+# (just n if minN not given) from list of words, each order in turn.
+# Grams are joined once per sliding window of the list, so no partial
+# strings are built and nothing is materialised until consumed.
+# With hashBits set each gram is replaced by its CRC-32 masked to
+# that many bits, a compact integer ID in place of the string.
+# Return iterator of ngrams
+#
+def ngrams(n,words,minN=None,hashBits=0):
+    if minN is None:
+        minN = n
+    orders = []
+    for size in range(max(minN,1),n+1):
+        if size == 1:
+            orders.append(iter(words))
+        else:
+            windows = itertools.izip(*[itertools.islice(words,k,None)
+                                       for k in range(size)])
+            orders.append(itertools.imap(' '.join,windows))
+    grams = itertools.chain.from_iterable(orders)
+    if hashBits:
+        mask = (1 << hashBits) - 1
+        grams = itertools.imap(lambda g: zlib.crc32(g) & mask,grams)
+    return grams
     
 # Convert any negation words, W (defined in negativeWords) found
 # in input word list into Not_W form
@@ -64,138 +151,2029 @@ def negate(words):
         i += 1
     return words
     
+# Read the preprocessing options from the config Parameters section
+# Return dictionary of option name to boolean/integer value
+#
+def readParameters(config):
+    params = {}
+    for option in BOOLEAN_PARAMETERS:
+        params[option] = config.getboolean('Parameters',option)
+    for option in INTEGER_PARAMETERS:
+        params[option] = config.getint('Parameters',option)
+    for option, default in OPTIONAL_PARAMETERS.iteritems():
+        if config.has_option('Parameters',option) and isinstance(default,str):
+            params[option] = config.get('Parameters',option).strip().lower()
+        elif config.has_option('Parameters',option):
+            params[option] = config.getint('Parameters',option)
+        elif default is None:
+            params[option] = params[DEFAULT_FROM[option]]
+        else:
+            params[option] = default
+    if params['FeatureSelection'] not in FEATURE_SELECTIONS:
+        raise ValueError("FeatureSelection must be one of "+", ".join(FEATURE_SELECTIONS))
+    if params['NgramSize'] < 1:
+        raise ValueError("NgramSize must be at least 1")
+    if params['NgramMinSize'] < 1 or params['NgramMinSize'] > params['NgramSize']:
+        raise ValueError("NgramMinSize must be between 1 and NgramSize")
+    return params
+
+# Build the stages of the preprocessing pipeline for the given
+# parameters and stop word set. Lowercasing, punctuation and digit
+# removal are fused into a single translate per token using
+# precomputed tables, and stop words are dropped in the same pass,
+# so only one list is built before negation and ngrams.
+# Return list of (key, function) pairs, each function taking the
+# output of the one before. The key holds the stage's options, so
+# two configs with the same keys up to a stage have the same
+# output from it (see sweep).
+#
+def compileStages(params,stopList):
+    stages = []
+    table = LOWERCASE if params['Lowercase'] else None
+    deleteChars = ''
+    if params['RemovePunctuation']:
+        deleteChars += SYMBOLS
+    if params['RemoveDigits']:
+        deleteChars += DIGITS
+    stop = frozenset(stopList) if params['StopWords'] else None
+
+    if table is not None or deleteChars:
+        transform = operator.methodcaller('translate',table,deleteChars)
+        if stop is not None:
+            def normalise(words):
+                return [w for w in itertools.imap(transform,words) if w not in stop]
+        else:
+            def normalise(words):
+                return map(transform,words)
+    elif stop is not None:
+        def normalise(words):
+            return [w for w in words if w not in stop]
+    else:
+        normalise = None
+    if normalise is not None:
+        stages.append((('normalise',table is not None,deleteChars,stop is not None),
+                       normalise))
+
+    if params['Negation']:
+        # negate works in place
+        stages.append((('negate',),lambda words: negate(list(words))))
+
+    if params['Ngrams']:
+        n = params['NgramSize']
+        minN = params['NgramMinSize']
+        hashBits = params['NgramHashBits']
+        stages.append((('ngrams',n,minN,hashBits),
+                       lambda words: ngrams(n,words,minN,hashBits)))
+
+    if params['SingleOccurrencePerDoc']:
+        stages.append((('single',),set))
+
+    return stages
+
+# Build the preprocessing pipeline for the given parameters and
+# stop word set, see compileStages
+# Return function taking a word list and returning the transformed
+# words (a set if SingleOccurrencePerDoc, a lazy iterator if Ngrams,
+# a list otherwise), with the parameters used attached as its params
+# attribute
+#
+def compilePreprocessor(params,stopList):
+    compiled = compileStages(params,stopList)
+    if profiler is not None:
+        stages = [timedStage(key[0],func) for key, func in compiled]
+    else:
+        stages = [func for key, func in compiled]
+
+    def pipeline(words):
+        for stage in stages:
+            words = stage(words)
+        return(words)
+
+    # identifies the pipeline's output, see TokenCache: only the
+    # options that change the tokens, not e.g. ReduceFeature
+    key = json.dumps([params['PartOfSpeech']] + [key for key, func in compiled])
+    if params['StopWords']:
+        key += '\n' + ' '.join(sorted(stopList))
+    pipeline.params = params
+    pipeline.key = hashlib.md5(key).hexdigest()
+    return pipeline
+
+# Return the preprocessing pipeline for the current config,
+# compiling it on first use
+#
+def getPreprocessor():
+    global preprocessor
+    if preprocessor is None:
+        preprocessor = compilePreprocessor(readParameters(config),stopWords)
+    return preprocessor
+
 # Pre-process input word list according to configuration settings
-# Return transformed word list
+# Return transformed words, see compilePreprocessor
+#
+def preprocess(words):
+    return getPreprocessor()(words)
+
+##############################################################
+#
+# Profiling. With ProfileReport set in the config Runtime section
+# the wall time, documents, tokens and bytes handled by each stage
+# of a run are recorded, with the process peak memory when the
+# stage last finished, and written to that file as JSON at the end
+# of the run. Stages are:
+#
+#   read           reading documents from the corpus
+#   cache-lookup   token cache lookups (cache-store: writes)
+#   tag, split     part of speech filtering, splitting into words
+#   normalise, negate, ngrams, single
+#                  the preprocessing stages (see compileStages)
+#   count, merge   counting words, merging worker counts
+#   probabilities  calculating the word probabilities
+#   classify       scoring documents
+#   load, save     reading and writing the model file
 #
-def preprocess(words):         
-    if config.getboolean('Parameters','Lowercase') == True:
-        words = [w.lower() for w in words]
-        
-    if config.getboolean('Parameters','RemovePunctuation') == True:
-        words = [w.translate(None, SYMBOLS).strip() for w in words]
-        
-    if config.getboolean('Parameters','RemoveDigits') == True:
-        words = [w.translate(None, DIGITS).strip() for w in words]
-        
-    if config.getboolean('Parameters','StopWords') == True:
-        global stopWords
-        words = [w for w in words if w not in stopWords]
-               
-    if config.getboolean('Parameters','Negation') == True:
-        words = negate(words) 
-   
-    if config.getboolean('Parameters','Ngrams') == True:
-        n = config.getint('Parameters','NgramSize')
-        words = ngrams(n,words)
-        
-    if config.getboolean('Parameters','SingleOccurrencePerDoc') == True:
-        words = set(words) 
-        
-    return(words)
-
-# Update input word frequency dictionary and vocab set
-# for text in given filename
-#
-def updateVocabAndCounts(filename,vocab,dictCount):
+# Worker process stages are added to the parent's. With
+# ProgressInterval set to a number of seconds a progress line is
+# printed to stderr that often.
+#
+# With profiling off the stages are not wrapped and each batch
+# pays for just one check, so it costs next to nothing.
+#
+
+# Return the peak memory use of this process in megabytes, or None
+# where not available
+#
+def peakMemoryMB():
+    if resource is None:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    if sys.platform == 'darwin':
+        return peak / 1048576.0
+    return peak / 1024.0
+
+class Profiler(object):
+    def __init__(self,reportFile=None,progressInterval=0):
+        self.reportFile = reportFile
+        self.progressInterval = progressInterval
+        self.started = time.time()
+        self.lastProgress = self.started
+        self.stats = {}
+
+    # Record a call of stage taking seconds over docs documents
+    # holding tokens words and bytes characters
+    def add(self,stage,seconds,docs=0,tokens=0,bytes=0):
+        stats = self.stats.get(stage)
+        if stats is None:
+            stats = self.stats[stage] = {'seconds': 0.0,'calls': 0,'docs': 0,
+                                         'tokens': 0,'bytes': 0,'peakMemoryMB': None}
+        stats['seconds'] += seconds
+        stats['calls'] += 1
+        stats['docs'] += docs
+        stats['tokens'] += tokens
+        stats['bytes'] += bytes
+        stats['peakMemoryMB'] = peakMemoryMB()
+        if self.progressInterval and time.time() - self.lastProgress >= self.progressInterval:
+            self.progress()
+
+    # Add the stats of another process's profiler
+    def merge(self,stats):
+        for stage, other in stats.iteritems():
+            if stage not in self.stats:
+                self.stats[stage] = dict(other)
+                continue
+            mine = self.stats[stage]
+            for field in ('seconds','calls','docs','tokens','bytes'):
+                mine[field] += other[field]
+            mine['peakMemoryMB'] = max(mine['peakMemoryMB'],other['peakMemoryMB'])
+
+    # Print a progress line to stderr
+    def progress(self):
+        self.lastProgress = time.time()
+        elapsed = self.lastProgress - self.started
+        parts = []
+        for stage in ('read','count','classify'):
+            if stage in self.stats:
+                docs = self.stats[stage]['docs']
+                parts.append("%s %d docs (%.0f/s)" % (stage,docs,docs/elapsed))
+        memory = peakMemoryMB()
+        if memory is not None:
+            parts.append("peak %.0f MB" % memory)
+        sys.stderr.write("[%.1fs] %s\n" % (elapsed,", ".join(parts)))
+
+    # Return the report of the run as a dictionary
+    def report(self,command):
+        stages = {}
+        for stage, stats in self.stats.iteritems():
+            stats = dict(stats)
+            seconds = stats['seconds']
+            for field in ('docs','tokens','bytes'):
+                if stats[field] and seconds > 0:
+                    stats[field+'PerSecond'] = stats[field] / seconds
+            stages[stage] = stats
+        return {'command': command,
+                'wallSeconds': time.time() - self.started,
+                'peakMemoryMB': peakMemoryMB(),
+                'workers': getWorkerCount(),
+                'parameters': dict(config.items('Parameters')),
+                'stages': stages}
+
+    # Write the report of the run to the report file
+    def write(self,command):
+        f = open(self.reportFile,'w')
+        json.dump(self.report(command),f,indent=2,sort_keys=True)
+        f.close()
+
+# Times a stage from entering a with block to leaving it
+#
+class StageTimer(object):
+    def __init__(self,stage,docs,tokens,bytes):
+        self.stage = stage
+        self.docs = docs
+        self.tokens = tokens
+        self.bytes = bytes
+
+    def __enter__(self):
+        self.started = time.time()
+        return self
+
+    def __exit__(self,*exc):
+        profiler.add(self.stage,time.time()-self.started,self.docs,self.tokens,self.bytes)
+        return False
+
+# Stands in for StageTimer when not profiling
+#
+class NullTimer(object):
+    def __enter__(self):
+        return self
+
+    def __exit__(self,*exc):
+        return False
+
+NULL_TIMER = NullTimer()
+
+# Return a timer for a with block running stage over docs
+# documents; its tokens and bytes can be set within the block
+#
+def timed(stage,docs=0,tokens=0,bytes=0):
+    if profiler is None:
+        return NULL_TIMER
+    return StageTimer(stage,docs,tokens,bytes)
+
+# Return function calling preprocessing stage and recording
+# its time, materialising its output so a lazy stage is timed
+# in full
+#
+def timedStage(name,stage):
+    def run(words):
+        started = time.time()
+        tokens = len(words) if hasattr(words,'__len__') else 0
+        words = stage(words)
+        if not isinstance(words,(list,set)):
+            words = list(words)
+        profiler.add(name,time.time()-started,1,tokens)
+        return words
+    return run
+
+# Yield the documents (name, stamp, contents) from docs, recording
+# the time taken to read each
+#
+def timedDocs(docs):
+    docs = iter(docs)
+    while True:
+        started = time.time()
+        try:
+            doc = next(docs)
+        except StopIteration:
+            return
+        profiler.add('read',time.time()-started,1,0,len(doc[2] or ''))
+        yield doc
+
+# Start profiling the run if ProfileReport or ProgressInterval is
+# set in the config file
+#
+def startProfiler():
+    global profiler, preprocessor
+    reportFile = None
+    interval = 0
+    if config.has_option('Runtime','ProfileReport'):
+        reportFile = config.get('Runtime','ProfileReport').strip() or None
+    if config.has_option('Runtime','ProgressInterval'):
+        interval = config.getfloat('Runtime','ProgressInterval')
+    if reportFile or interval:
+        profiler = Profiler(reportFile,interval)
+        # recompile with the stages timed
+        preprocessor = None
+
+# Write the profile report of the run, if profiling
+#
+def writeProfile(command):
+    if profiler is not None and profiler.reportFile:
+        profiler.write(command)
+        print "Profile written to",profiler.reportFile
+
+##############################################################
+#
+# Corpus reading. A corpus location (a ...Dir setting in the
+# config file, or a directory given on the command line) can be:
+#
+#   a directory           one document per file, as before
+#   a .zip, .tar[.gz|.bz2], .tgz or .7z archive, optionally
+#   followed by a path inside it (e.g. SmallIMDB.7z/SmallIMDB/neg)
+#                         every file member under that path,
+#                         streamed without extracting
+#   a .jsonl file         one JSON document per line, either a
+#                         string or an object with a "text" field
+#   any other file        one document per line
+#
+# 7z archives need the py7zlib module of the pylzma package
+# (pip install pylzma), which supports Python 2 unlike py7zr.
+#
+ZIP_EXTENSIONS = ('.zip',)
+TAR_EXTENSIONS = ('.tar','.tar.gz','.tgz','.tar.bz2','.tbz2')
+SEVENZIP_EXTENSIONS = ('.7z',)
+
+# Split location into an archive or packed file path and the
+# path inside it (None for a plain directory). Either slash
+# separates the parts, as in the config file's Windows paths.
+# Return tuple of (file path, inner path) or (None, None)
+#
+def splitCorpusLocation(location):
+    if os.path.isdir(location):
+        return None,None
+    head = location.replace('\\','/').rstrip('/')
+    inner = []
+    while head:
+        if os.path.isfile(head):
+            return head,'/'.join(reversed(inner))
+        head, tail = os.path.split(head)
+        if not tail:
+            break
+        inner.append(tail)
+    raise IOError("No such corpus directory, archive or file: "+location)
+
+# Return true if archive member name is under inner path
+#
+def underPath(name,inner):
+    return not inner or name == inner or name.startswith(inner+'/')
+
+# Yield (name, contents) of each member file of a zip archive
+#
+def readZip(filename,inner):
+    zf = zipfile.ZipFile(filename)
+    try:
+        for info in zf.infolist():
+            if not info.filename.endswith('/') and underPath(info.filename,inner):
+                yield filename+'/'+info.filename, zf.read(info)
+    finally:
+        zf.close()
+
+# Yield (name, contents) of each member file of a tar archive,
+# reading it as a stream
+#
+def readTar(filename,inner):
+    tf = tarfile.open(filename,'r|*')
+    try:
+        for member in tf:
+            if member.isfile() and underPath(member.name,inner):
+                yield filename+'/'+member.name, tf.extractfile(member).read()
+    finally:
+        tf.close()
+
+# Yield (name, contents) of each member file of a 7z archive
+#
+def read7z(filename,inner):
+    if py7zlib is None:
+        raise IOError("Reading "+filename+" needs the py7zlib module (pip install pylzma)")
+    f = open(filename,'rb')
+    try:
+        archive = py7zlib.Archive7z(f)
+        for name in archive.getnames():
+            if underPath(name,inner):
+                yield filename+'/'+name, archive.getmember(name).read()
+    finally:
+        f.close()
+
+# Yield (name, contents) of each line of a packed corpus file
+#
+def readPacked(filename):
+    isJson = filename.lower().endswith('.jsonl')
     f = open(filename,'r')
-    contents = f.read()   
-    f.close()
+    try:
+        for lineNumber, line in enumerate(f):
+            if not line.strip():
+                continue
+            if isJson:
+                doc = json.loads(line)
+                if isinstance(doc,dict):
+                    doc = doc['text']
+                if isinstance(doc,unicode):
+                    doc = doc.encode('utf-8')
+            else:
+                doc = line
+            yield filename+':'+str(lineNumber+1), doc
+    finally:
+        f.close()
 
-    if config.getboolean('Parameters','PartOfSpeech') == True:
-        tb = TextBlob(contents)
-        pos = tb.tags
-        words = [w[0] for w in pos if w[1][1] in 'JRVN']
+# Return the (size, modification time) of filename, which
+# changes whenever the file does
+#
+def fileStamp(filename):
+    st = os.stat(filename)
+    return st.st_size,st.st_mtime
+
+# Return iterator of (name, stamp, contents) of every document at
+# corpus location, see above. The stamp is the fileStamp of the
+# file the document was read from. The files of a directory are
+# only stat'ed here, with contents None, and read when needed (see
+# loadDocuments), so a token cache hit doesn't read them at all.
+#
+def readCorpus(location):
+    if profiler is not None:
+        return timedDocs(corpusDocuments(location))
+    return corpusDocuments(location)
+
+# Yield the documents of readCorpus
+#
+def corpusDocuments(location):
+    filename, inner = splitCorpusLocation(location)
+    if filename is None:
+        for eachFile in os.listdir(location):
+            path = os.path.join(location,eachFile)
+            yield path, fileStamp(path), None
+        return
+    lower = filename.lower()
+    if lower.endswith(ZIP_EXTENSIONS):
+        docs = readZip(filename,inner)
+    elif lower.endswith(TAR_EXTENSIONS):
+        docs = readTar(filename,inner)
+    elif lower.endswith(SEVENZIP_EXTENSIONS):
+        docs = read7z(filename,inner)
     else:
-        words = contents.split()
-  
-    words = preprocess(words)
-    
-    for w in words:      
-        vocab.add(w)
-        dictCount.setdefault(w,0)
-        dictCount[w] += 1            
+        docs = readPacked(filename)
+    stamp = fileStamp(filename)
+    for name, contents in docs:
+        yield name, stamp, contents
 
-# Classify document as either positive or negative based
-# on word probability dictionary values
-#            
-def classifyDoc(filename,probWordForPositive,probPositive,
-                probWordForNegative,probNegative):
+# Return list of corpus documents docs with the contents of any
+# not yet read (see readCorpus) read
+#
+def loadDocuments(docs):
+    loaded = []
+    with timed('read') as timer:
+        for name, stamp, contents in docs:
+            if contents is None:
+                f = open(name,'r')
+                contents = f.read()
+                f.close()
+                if profiler is not None:
+                    timer.bytes += len(contents)
+            loaded.append((name,stamp,contents))
+    return loaded
+
+# Group iterable into lists of up to n items
+#
+def chunks(items,n):
+    chunk = []
+    for item in items:
+        chunk.append(item)
+        if len(chunk) == n:
+            yield chunk
+            chunk = []
+    if chunk:
+        yield chunk
+
+##############################################################
+#
+# Token cache. Pre-processing a document is by far the slowest
+# part of a run, so the word list made from each corpus document
+# is kept on disk under a key made from the document's name and
+# stamp and the key of the preprocessing pipeline. A document or
+# config change gives a new key, so stale entries are never read;
+# they are removed, least recently used first, when the cache
+# grows past its size cap. The cache's size is kept in its usage
+# file - the total found by the last full scan followed by the
+# size of each batch of entries added since - so the cache is only
+# scanned when that passes the cap. Set in the config Runtime
+# section:
+#
+#   TokenCacheDir    cache directory (no option: no cache)
+#   TokenCacheSize   size cap in megabytes, default 256
+#
+# The part of speech filtered words of each document are cached
+# too, keyed by the tagger rather than the pipeline, so changing
+# other options doesn't mean tagging again.
+#
+WORDS = 'words'
+POS_WORDS = 'pos'
+USAGE_FILE = 'usage'
+
+class TokenCache(object):
+    def __init__(self,path,maxBytes):
+        self.path = path
+        self.maxBytes = maxBytes
+        self.added = 0
+
+    # Return the cache file for document (name, stamp) of the
+    # given kind made by key, by default the current pipeline's
+    def entryFile(self,kind,name,stamp,key=None):
+        if key is None:
+            key = getPreprocessor().key
+        key = repr((kind,key,name,stamp))
+        digest = hashlib.md5(key).hexdigest()
+        return os.path.join(self.path,digest[:2],digest[2:])
+
+    # Return the cached word list or None if not cached
+    def get(self,entry):
+        try:
+            f = open(entry,'rb')
+        except IOError:
+            return None
+        try:
+            words = marshal.load(f)
+        except (EOFError,ValueError,TypeError):
+            words = None
+        f.close()
+        if words is not None:
+            # mark as recently used
+            try:
+                os.utime(entry,None)
+            except OSError:
+                pass
+        return words
+
+    # Store word list in the cache. Written to a temporary file
+    # and renamed, so concurrent workers never see a partial entry.
+    def put(self,entry,words):
+        folder = os.path.dirname(entry)
+        if not os.path.isdir(folder):
+            try:
+                os.makedirs(folder)
+            except OSError:
+                pass
+        tmpFile = entry+'.'+str(os.getpid())
+        f = open(tmpFile,'wb')
+        marshal.dump(words,f)
+        self.added += f.tell()
+        f.close()
+        try:
+            os.rename(tmpFile,entry)
+        except OSError:
+            # Windows: already written by another worker
+            os.remove(tmpFile)
+
+    # Append the size of the entries put since last called to the
+    # usage file, if there is one (else the next trim scans the
+    # cache). Lines appended by concurrent processes don't mix.
+    def recordUsage(self):
+        usageFile = os.path.join(self.path,USAGE_FILE)
+        if self.added and os.path.exists(usageFile):
+            try:
+                f = open(usageFile,'a')
+                f.write(str(self.added)+'\n')
+                f.close()
+            except IOError:
+                pass
+        self.added = 0
+
+    # Return the size of the cache recorded in the usage file, or
+    # None if not known
+    def usage(self):
+        try:
+            f = open(os.path.join(self.path,USAGE_FILE),'r')
+        except IOError:
+            return None
+        try:
+            return sum(int(line) for line in f)
+        except ValueError:
+            return None
+        finally:
+            f.close()
+
+    # Remove the least recently used entries until the cache
+    # is within its size cap, scanning it only if its recorded
+    # size is over the cap or not known
+    def trim(self):
+        self.recordUsage()
+        total = self.usage()
+        if total is not None and total <= self.maxBytes:
+            return 0
+        entries = []
+        total = 0
+        for folder, dirs, files in os.walk(self.path):
+            if folder == self.path:
+                continue        # the usage file
+            for name in files:
+                path = os.path.join(folder,name)
+                st = os.stat(path)
+                entries.append((st.st_mtime,st.st_size,path))
+                total += st.st_size
+        entries.sort()
+        removed = 0
+        for mtime, size, path in entries:
+            if total <= self.maxBytes:
+                break
+            os.remove(path)
+            total -= size
+            removed += 1
+        if os.path.isdir(self.path):
+            usageFile = os.path.join(self.path,USAGE_FILE)
+            f = open(usageFile+'.'+str(os.getpid()),'w')
+            f.write(str(total)+'\n')
+            f.close()
+            try:
+                os.rename(usageFile+'.'+str(os.getpid()),usageFile)
+            except OSError:
+                # Windows will not rename over an existing file
+                os.remove(usageFile)
+                os.rename(usageFile+'.'+str(os.getpid()),usageFile)
+        return removed
+
+# Return the token cache set in the config file, or None
+#
+def getTokenCache():
+    global tokenCache
+    if tokenCache is None and config.has_option('Runtime','TokenCacheDir'):
+        size = 256
+        if config.has_option('Runtime','TokenCacheSize'):
+            size = config.getint('Runtime','TokenCacheSize')
+        tokenCache = TokenCache(config.get('Runtime','TokenCacheDir'),size << 20)
+    return tokenCache
+
+# Return the cached list of words made by function words for each
+# of list of corpus documents (name, stamp, contents), calling it
+# with the list of documents not cached (or without a stamp), read
+# (see loadDocuments), and caching its results
+#
+def cachedWords(docs,kind,words,key=None):
+    cache = getTokenCache()
+    if cache is None:
+        return words(loadDocuments(docs))
+    result = [None] * len(docs)
+    entries = [None] * len(docs)
+    with timed('cache-lookup',len(docs)):
+        for i, (name, stamp, contents) in enumerate(docs):
+            if stamp is not None:
+                entries[i] = cache.entryFile(kind,name,stamp,key)
+                result[i] = cache.get(entries[i])
+    missing = [i for i in range(len(docs)) if result[i] is None]
+    if missing:
+        made = words(loadDocuments([docs[i] for i in missing]))
+        with timed('cache-store',len(missing)):
+            for i, w in zip(missing,made):
+                result[i] = w
+                if entries[i] is not None:
+                    result[i] = list(w)
+                    cache.put(entries[i],result[i])
+            cache.recordUsage()
+    return result
+
+# Trim the token cache, if any, to its size cap
+#
+def trimTokenCache():
+    cache = getTokenCache()
+    if cache is not None:
+        cache.trim()
+
+##############################################################
+#
+# Part of speech filter. With PartOfSpeech set only the
+# adjectives, adverbs, verbs and nouns of a document are kept, in
+# training and classification alike. Documents are tagged in
+# batches by NLTK's perceptron tagger (the one TextBlob uses),
+# loaded once per process, spread over a pool of Workers processes
+# and cached per document (see TokenCache).
+#
+# Needs nltk with its punkt and averaged_perceptron_tagger data.
+#
+POS_KEEP = 'JRVN'
+POS_KEY = 'nltk-perceptron-'+POS_KEEP
+
+# Return the part of speech tagger, loading it on first use
+#
+def getPosTagger():
+    global posTagger
+    if posTagger is None:
+        if nltk is None:
+            raise ImportError("PartOfSpeech needs nltk: pip install nltk; python -m nltk.downloader "
+                              "punkt averaged_perceptron_tagger")
+        posTagger = nltk.tag.PerceptronTagger()
+    return posTagger
+
+# Tag a list of document texts, keeping only the words tagged as
+# adjectives (JJ*), adverbs (RB*), verbs (VB*) and nouns (NN*)
+# Return list of word lists
+#
+def posFilter(texts):
+    tagger = getPosTagger()
+    result = []
+    for text in texts:
+        tokens = nltk.word_tokenize(text.decode('utf-8','replace'))
+        result.append([w.encode('utf-8') for w, tag in tagger.tag(tokens)
+                       if tag[:1] in POS_KEEP])
+    return result
+
+# Return a pool of Workers processes to tag documents with, or None
+# if not tagging or there is only one worker
+#
+def startTagPool(partOfSpeech):
+    workers = getWorkerCount()
+    if partOfSpeech != True or workers <= 1:
+        return None
+    return multiprocessing.Pool(workers,initWorker,(stopWords,dict(config.items('Parameters'))))
+
+# Close a pool returned by startTagPool
+#
+def stopTagPool(pool):
+    if pool is not None:
+        pool.close()
+        pool.join()
+
+# Return the part of speech filtered words of each of list of
+# corpus documents, tagging those not cached in pool if given
+#
+def posWords(docs,pool=None):
+    def tag(docs):
+        texts = [contents for name, stamp, contents in docs]
+        with timed('tag',len(texts)):
+            if pool is None or len(texts) < 2:
+                return posFilter(texts)
+            shards = list(chunks(texts,-(-len(texts) // getWorkerCount())))
+            return list(itertools.chain.from_iterable(pool.map(posFilter,shards)))
+    return cachedWords(docs,POS_WORDS,tag,POS_KEY)
+
+# Split a list of corpus documents into words, filtered by part of
+# speech if PartOfSpeech is set
+# Return list of word lists
+#
+def documentTokens(docs,pool=None):
+    if getPreprocessor().params['PartOfSpeech'] == True:
+        return posWords(docs,pool)
+    with timed('split',len(docs)) as timer:
+        tokens = [contents.split() for name, stamp, contents in docs]
+        if profiler is not None:
+            timer.tokens = sum(len(words) for words in tokens)
+        return tokens
+
+# Return the pre-processed words of each of list of corpus
+# documents, see readCorpus. pool is used for part of speech
+# tagging (see startTagPool).
+#
+def documentWords(docs,pool=None):
+    def words(docs):
+        return [preprocess(tokens) for tokens in documentTokens(docs,pool)]
+    return cachedWords(docs,WORDS,words)
+
+##############################################################
+
+# Update the model's term counts for class c with the words
+# of a list of training documents, see readCorpus
+#
+def updateVocabAndCounts(docs,model,c):
+    docWords = documentWords(docs)
+    with timed('count',len(docs)):
+        for words in docWords:
+            model.addWords(words,c)
+
+# Initialise a worker process with the stop words and Parameters
+# of the parent, as spawned workers (always so on Windows) never
+# run main() and would otherwise take bayes.ini's, which need not
+# match e.g. a model being updated, and with profiling if the
+# parent is
+#
+def initWorker(words,parameters,profiling=False):
+    global profiler
+    setParameters(parameters)
+    setStopWords(words)
+    if profiling:
+        profiler = Profiler()
+
+# Count the words of the shards of documents taken from queue
+# tasks, until it gives None, within a worker process. The counts
+# of all the worker's shards are kept in one model, so each term
+# goes back to the parent once per worker rather than once per
+# shard. Puts on queue results a tuple of the number of documents,
+# the worker's terms in the order it first saw them, their
+# counts, the sequence number of the shard each was first seen in
+# and the profile stats (or None), or of None and the error if
+# counting failed.
+#
+def countWorker(tasks,results,words,parameters,profiling):
+    initWorker(words,parameters,profiling)
+    model = NaiveBayesModel()
+    docCount = 0
+    seqs = []
+    sizes = [0]
+    error = None
+    for seq, docs in iter(tasks.get,None):
+        if error is not None:
+            continue        # keep taking shards so the parent isn't blocked
+        try:
+            updateVocabAndCounts(docs,model,0)
+            docCount += len(docs)
+            seqs.append(seq)
+            sizes.append(len(model.termIds))
+        except Exception:
+            error = traceback.format_exc()
+    if error is not None:
+        results.put((None,error,None,None,None))
+        return
+    firstShard = np.repeat(np.array(seqs,dtype=np.int64),np.diff(sizes))
+    results.put((docCount,model.termIds.termList(),model.termCounts()[0],firstShard,
+                 profiler.stats if profiler is not None else None))
+
+# Count the words of documents in shards of SHARD_SIZE spread over
+# workers processes, see countWorker
+# Return list of the workers' results
+#
+def countParallel(docs,workers):
+    tasks = multiprocessing.Queue(2*workers)
+    results = multiprocessing.Queue()
+    processes = [multiprocessing.Process(target=countWorker,
+                                         args=(tasks,results,stopWords,
+                                               dict(config.items('Parameters')),
+                                               profiler is not None))
+                 for i in range(workers)]
+    for process in processes:
+        process.start()
+    try:
+        for seq, shard in enumerate(chunks(docs,SHARD_SIZE)):
+            tasks.put((seq,shard))
+    finally:
+        for process in processes:
+            tasks.put(None)
+        parts = [results.get() for process in processes]
+        for process in processes:
+            process.join()
+    for docCount, terms, counts, firstShard, stats in parts:
+        if docCount is None:
+            raise RuntimeError("Training worker failed:\n"+terms)
+    return parts
+
+# Merge the workers' results of countParallel into one list of
+# distinct terms and array of their counts, with sorts over all
+# the workers' terms at once rather than a dictionary insert per
+# term. Terms are listed in the order the serial path would first
+# see them - by the shard first seen in, then by where in it - so
+# they get the same IDs in the model.
+# Return tuple of the list of terms and array of counts
+#
+def mergeCounts(parts):
+    values = np.empty(sum(len(part[1]) for part in parts),dtype=object)
+    if len(values) == 0:
+        return [],np.zeros(0,dtype=np.int64)
+    values[:] = list(itertools.chain.from_iterable(part[1] for part in parts))
+    counts = np.concatenate([part[2] for part in parts])
+    seen = np.concatenate([(part[3] << 32) + np.arange(len(part[1]),dtype=np.int64)
+                           for part in parts])
+    byKey, starts = groupTerms(values)
+    totals = np.add.reduceat(counts[byKey],starts)
+    order = np.argsort(np.minimum.reduceat(seen[byKey],starts))
+    return values[byKey[starts[order]]].tolist(),totals[order]
+
+# Group the equal terms of object array values. Terms are sorted
+# by their hash, far faster than sorting the strings, unless two
+# different terms share a hash.
+# Return the indices of values sorted into groups and the start of
+# each group in them
+#
+def groupTerms(values):
+    if isinstance(values[0],(int,long)):
+        keys = values.astype(np.int64)
+    else:
+        keys = np.fromiter(itertools.imap(hash,values),dtype=np.int64,count=len(values))
+    byKey = np.argsort(keys)
+    same = keys[byKey[1:]] == keys[byKey[:-1]]
+    if keys.dtype != values.dtype:
+        if (same & (values[byKey[1:]] != values[byKey[:-1]])).any():
+            byKey = np.argsort(values,kind='mergesort')
+            same = values[byKey[1:]] == values[byKey[:-1]]
+    return byKey,np.flatnonzero(np.r_[True,~same])
+
+# Return the number of training worker processes set in the
+# config file, defaulting to a single (serial) process
+#
+def getWorkerCount():
+    if config.has_option('Runtime','Workers'):
+        workers = config.getint('Runtime','Workers')
+        if workers <= 0:
+            workers = multiprocessing.cpu_count()
+        return workers
+    return 1
+
+# Read and pre-process the words of the document in filename
+# Return transformed words
+#
+def readDocWords(filename):
     f = open(filename,'r')
     contents = f.read()
-    words = contents.split()
     f.close()
-        
-    words = preprocess(words)
-        
-    probDocPositive = probPositive
-    probDocNegative = probNegative
-        
-    for w in words:
-        if (w in probWordForPositive):
-            probDocPositive += probWordForPositive[w]
-        if (w in probWordForNegative):
-            probDocNegative += probWordForNegative[w]
-        
-    if (probDocPositive > probDocNegative):
-        return(1)
-    else: 
-        return(-1)
-
-# Read stop words file specified in config file into stopWords string
-#
-def getStopWords():   
+    return documentWords([(filename,fileStamp(filename),contents)])[0]
+
+# Classify document as either positive or negative based
+# on the model's word probabilities
+#
+def classifyDoc(filename,model):
+    return model.classifyWords(readDocWords(filename))
+
+# Set the stop word set used by preprocess
+#
+def setStopWords(words):
+    global stopWords, preprocessor
+    stopWords = frozenset(words)
+    preprocessor = None
+
+# Read stop words file specified in config file into stopWords set
+#
+def getStopWords():
     filename = config.get('Data', 'StopWordFile')
     f = open(filename)
-    global stopWords
-    stopWords = f.read()
+    setStopWords(f.read().split())
     f.close()
     return stopWords
 
-# Return the top n highest elements of dictionary, A based on 
-# dictionary's values.
+# Return the indices of the top n highest values in
+# count array, A, highest first. Only the values above the n'th
+# highest are sorted, found by partitioning; ties at the cutoff
+# are kept in index order, as a full stable sort would.
 #
 def reduceW(A, n):
-    dd = sorted(A.iteritems(), key=itemgetter(1), reverse=True)[:n]
-    result_dict = {}
-    for t in dd:
-        result_dict[t[0]] = t[1]
-    return result_dict
-
-# For every file in specified path directory
-# update our word count dictionary and overall vocab set
+    if n >= len(A):
+        return np.argsort(-A,kind='mergesort')
+    if n <= 0:
+        return np.zeros(0,dtype=np.int64)
+    cutoff = -np.partition(-A,n-1)[n-1]
+    above = np.flatnonzero(A > cutoff)
+    ties = np.flatnonzero(A == cutoff)[:n-len(above)]
+    keep = np.concatenate([above,ties])
+    return keep[np.argsort(-A[keep],kind='mergesort')]
+
+# Score every term for FeatureSelection method from the
+# per-class term counts, in one pass over the count arrays. Each
+# term is treated as a 2x2 table of its occurrences and all other
+# occurrences in each class (document frequencies when
+# SingleOccurrencePerDoc is set):
+#
+#   chi2     chi-squared statistic of the table
+#   mi       mutual information between term and class
+#   logodds  absolute log ratio of the smoothed P(term|class)
+#
+# Return array of scores, higher for terms telling the classes
+# apart better
+#
+def featureScores(counts,method):
+    counts = counts.astype(np.float64)
+    classTotals = counts.sum(axis=1)
+    inClass = counts
+    outClass = classTotals[:,np.newaxis] - counts
+    total = classTotals.sum()
+    with np.errstate(divide='ignore',invalid='ignore'):
+        if method == 'logodds':
+            vocabSize = np.count_nonzero(counts.sum(axis=0))
+            p = (inClass + 1.0) / (classTotals[:,np.newaxis] + vocabSize)
+            scores = np.abs(np.log10(p[POSITIVE]) - np.log10(p[NEGATIVE]))
+        elif method == 'chi2':
+            a, b = inClass[POSITIVE], inClass[NEGATIVE]
+            c, d = outClass[POSITIVE], outClass[NEGATIVE]
+            scores = total * (a*d - b*c)**2 / ((a+b) * (c+d) * (a+c) * (b+d))
+        elif method == 'mi':
+            scores = np.zeros(counts.shape[1])
+            term = inClass.sum(axis=0) / total
+            classes = classTotals / total
+            for cells, pTerm in ((inClass,term),(outClass,1.0-term)):
+                for c in (NEGATIVE,POSITIVE):
+                    pCell = cells[c] / total
+                    scores += np.where(pCell > 0,pCell*np.log2(pCell/(pTerm*classes[c])),0.0)
+        else:
+            raise ValueError("Unknown feature selection: "+method)
+    scores[~np.isfinite(scores)] = 0.0
+    return scores
+
+# For every document at corpus location path
+# update the model's counts for class c
 # return the count of documents processed
-#    
-def trainNB(path,vocab,wordCountDict):
+#
+# With more than one worker the documents are read here in shards
+# of SHARD_SIZE which are counted in parallel, each worker into
+# its own counts, and the workers' counts merged once at the end
+# (map-reduce), giving exactly the same counts and term IDs as the
+# serial path.
+#
+def trainNB(path,model,c,workers=1):
+    docCount = 0
+    if workers <= 1:
+        for docs in chunks(readCorpus(path),SHARD_SIZE):
+            docCount += len(docs)
+            updateVocabAndCounts(docs,model,c)
+    else:
+        parts = countParallel(readCorpus(path),workers)
+        docCount = sum(part[0] for part in parts)
+        with timed('merge',docCount,sum(len(part[1]) for part in parts)):
+            terms, counts = mergeCounts(parts)
+            model.addCounts(terms,counts,c)
+        for part in parts:
+            if part[4] is not None:
+                profiler.merge(part[4])
+    model.docCounts[c] += docCount
+    return(docCount)
+
+# Remove every document at corpus location path from the
+# model's counts for class c, undoing trainNB
+# return the count of documents removed
+#
+def untrainNB(path,model,c):
     docCount = 0
-    listing = os.listdir(path)
-    for eachFile in listing:
-        docCount += 1
-        updateVocabAndCounts(path+eachFile,vocab,wordCountDict)
-    return(docCount) 
-
-# Classify every file in the specified directory, 
-# given expected sentiment and our trained probability dictionaries
+    pool = startTagPool(getPreprocessor().params['PartOfSpeech'])
+    try:
+        for docs in chunks(readCorpus(path),SHARD_SIZE):
+            docCount += len(docs)
+            for words in documentWords(docs,pool):
+                model.removeWords(words,c)
+    finally:
+        stopTagPool(pool)
+    model.docCounts[c] -= docCount
+    return(docCount)
+
+# Classify a list of texts in batches of batchSize
+# Return array of labels and array of per-class log scores,
+# see NaiveBayesModel.classifyDocs
+#
+def classifyTexts(texts,model,batchSize=BATCH_SIZE):
+    labels = []
+    scores = []
+    pool = startTagPool(getPreprocessor().params['PartOfSpeech'])
+    try:
+        for start in range(0,len(texts),batchSize):
+            docs = [(None,None,text) for text in texts[start:start+batchSize]]
+            l, s = model.classifyDocs(documentWords(docs,pool))
+            labels.append(l)
+            scores.append(s)
+    finally:
+        stopTagPool(pool)
+    if not labels:
+        return np.zeros(0,dtype=int),np.zeros((0,2))
+    return np.concatenate(labels),np.concatenate(scores)
+
+# Classify every document at corpus location path in batches
+# Return list of document names, array of labels and array of
+# per-class log scores
+#
+def classifyCorpus(path,model,batchSize=BATCH_SIZE):
+    names = []
+    labels = []
+    scores = []
+    pool = startTagPool(getPreprocessor().params['PartOfSpeech'])
+    try:
+        for batch in chunks(readCorpus(path),batchSize):
+            names.extend(name for name, stamp, contents in batch)
+            l, s = model.classifyDocs(documentWords(batch,pool))
+            labels.append(l)
+            scores.append(s)
+    finally:
+        stopTagPool(pool)
+    if not labels:
+        return names,np.zeros(0,dtype=int),np.zeros((0,2))
+    return names,np.concatenate(labels),np.concatenate(scores)
+
+# Classify every document at corpus location dirPath,
+# given expected sentiment and our trained model
 # Return the number of documents processed and the
 # number of correctly classified
 #
-def doClassification(dirPath,sentiment,
-                     probWordForPositive,probPositive,
-                     probWordForNegative,probNegative):
-    nClassified = 0
-    nTestDocs = 0
-    listing = os.listdir(dirPath)
-    for eachFile in listing:
-        nTestDocs += 1
-        docClass = classifyDoc(dirPath+eachFile,
-                             probWordForPositive,probPositive,
-                             probWordForNegative,probNegative)
-        if (docClass == -1 and sentiment == -1):
-            nClassified += 1
-        elif (docClass == 1 and sentiment == 1):
-            nClassified += 1
-            
+def doClassification(dirPath,sentiment,model):
+    names, labels, scores = classifyCorpus(dirPath,model)
+    nTestDocs = len(names)
+    nClassified = int(np.count_nonzero(labels == sentiment))
     return nTestDocs,nClassified
-            
+
+##############################################################
+#
+# Naive Bayes model. Each term is given an integer ID by a single
+# term-to-ID map and all per-term data is held in dense arrays
+# indexed by ID, with one row per class:
+#
+#   counts   int64[2,V]    occurrences of each term in each class
+#   logProb  float64[2,V]  log10 P(term|class)
+#
+# A log-probability of 0.0 marks a term dropped from a class by
+# ReduceFeature (or no longer in any document); real values are
+# always negative so adding it is the same as skipping the term.
+#
+# Documents can be added to or removed from a trained (or loaded)
+# model at any time. Only the counts are updated; the
+# probabilities are recalculated from them the next time the
+# model is used for scoring or saved.
+#
+NEGATIVE = 0
+POSITIVE = 1
+CLASS_LABELS = [-1,1]
+
+# Number of term IDs buffered per class before they are added
+# into the count arrays by a single bincount
+FLUSH_SIZE = 1 << 20
+
+class NaiveBayesModel(object):
+    def __init__(self):
+        self.termIds = Vocabulary()
+        self.counts = np.zeros((2,0),dtype=np.int64)
+        self.pending = [array.array('l'),array.array('l')]
+        self.retracted = [array.array('l'),array.array('l')]
+        self.docCounts = [0,0]
+        self.vocabSize = 0
+        self.reduceCount = 0
+        self.selection = 'frequency'
+        self.logProb = None
+        self.priors = None
+        self.stale = True
+        self.parameters = None
+        self.stopWords = frozenset()
+
+    # Count the words of a document of class c
+    def addWords(self,words,c):
+        pending = self.pending[c]
+        pending.extend(self.termIds.add(words))
+        self.stale = True
+        if len(pending) >= FLUSH_SIZE:
+            self.flush()
+
+    # Uncount the words of a document of class c that was
+    # previously added
+    def removeWords(self,words,c):
+        ids = self.termIds.lookup(list(words))
+        if (ids < 0).any():
+            raise ValueError("removed document has words not in the model")
+        self.retracted[c].extend(ids.tolist())
+        self.stale = True
+        if len(self.retracted[c]) >= FLUSH_SIZE:
+            self.flush()
+
+    # Add counts for a list of distinct terms in class c,
+    # e.g. counted by worker processes
+    def addCounts(self,terms,counts,c):
+        ids = self.termIds.addDistinct(terms)
+        self.flush(True)
+        self.counts[c][ids] += counts
+        self.stale = True
+
+    # Add (and subtract) the buffered term IDs into the count arrays,
+    # growing them to cover any new terms. Counts of a loaded model
+    # are copied out of the read-only mapping on first change.
+    def flush(self,writing=False):
+        n = len(self.termIds)
+        writing = writing or any(len(ids) for ids in self.pending + self.retracted)
+        if self.counts.shape[1] < n or (writing and not self.counts.flags.writeable):
+            counts = np.zeros((2,max(n,2*self.counts.shape[1])),dtype=np.int64)
+            counts[:,:self.counts.shape[1]] = self.counts
+            self.counts = counts
+        for c in (NEGATIVE,POSITIVE):
+            if len(self.pending[c]):
+                ids = np.frombuffer(self.pending[c],dtype=np.int_)
+                self.counts[c,:n] += np.bincount(ids,minlength=n)
+                self.pending[c] = array.array('l')
+            if len(self.retracted[c]):
+                ids = np.frombuffer(self.retracted[c],dtype=np.int_)
+                removed = np.bincount(ids,minlength=n)
+                self.retracted[c] = array.array('l')
+                if (self.counts[c,:n] < removed).any():
+                    raise ValueError("removed more occurrences of a word than were added")
+                self.counts[c,:n] -= removed
+
+    # Return the count arrays for the terms seen so far
+    def termCounts(self):
+        self.flush()
+        return self.counts[:,:len(self.termIds)]
+
+    # Calculate the probabilities for each word given both classes
+    # and calculate the standalone probability for each class:
+    #
+    # for each word, w in docs of class Ci:
+    #   P(w|Ci) = count(w,Ci) + 1 / count(Ci) + |vocab|
+    # for each class Ci:
+    #   P(Ci) = |docs of class Ci| / | total docs |
+    #
+    # If reduceCount is given only reduceCount terms are kept as
+    # features: the most frequent of each class, or the terms
+    # ranked highest by selection for both classes (see
+    # featureScores).
+    # Return the number of features per class
+    #
+    def computeProbabilities(self,reduceCount=0,selection='frequency'):
+        counts = self.termCounts()
+        present = counts.sum(axis=0) > 0
+        self.vocabSize = int(np.count_nonzero(present))
+        self.reduceCount = reduceCount
+        self.selection = selection
+        self.logProb = np.zeros(counts.shape)
+        if reduceCount and selection != 'frequency':
+            shared = reduceW(featureScores(counts,selection),reduceCount)
+            shared = shared[present[shared]]
+        for c in (NEGATIVE,POSITIVE):
+            if reduceCount and selection != 'frequency':
+                keep = shared
+            elif reduceCount:
+                keep = reduceW(counts[c],reduceCount)
+                keep = keep[present[keep]]
+            else:
+                keep = np.flatnonzero(present)
+            denom = counts[c][keep].sum() + self.vocabSize
+            self.logProb[c][keep] = np.log10((counts[c][keep] + 1.0) / denom)
+
+        total = self.docCounts[NEGATIVE] + self.docCounts[POSITIVE]
+        self.priors = [math.log10(float(n) / total) for n in self.docCounts]
+        self.stale = False
+        if reduceCount:
+            return min(reduceCount,self.vocabSize)
+        return self.vocabSize
+
+    # Recalculate the probabilities if documents have been added
+    # or removed since they were last calculated
+    def refresh(self):
+        if self.stale:
+            with timed('probabilities'):
+                self.computeProbabilities(self.reduceCount,self.selection)
+
+    # Build the sparse document-term count matrix of a list of
+    # pre-processed documents against the model's vocabulary.
+    # Words are numbered within the batch first so each distinct
+    # word is looked up in the vocabulary only once.
+    def docTermMatrix(self,docs):
+        batchIds = Vocabulary()
+        indices = array.array('l')
+        indptr = array.array('l',[0])
+        for words in docs:
+            indices.extend(batchIds.add(words))
+            indptr.append(len(indices))
+        ids = self.termIds.lookup(batchIds.termList())
+        cols = ids[np.frombuffer(indices,dtype=np.int_)]
+        rows = np.repeat(np.arange(len(indptr)-1),np.diff(indptr))
+        found = cols >= 0
+        return scipy.sparse.csr_matrix((np.ones(np.count_nonzero(found)),
+                                        (rows[found],cols[found])),
+                                       shape=(len(indptr)-1,self.logProb.shape[1]))
+
+    # Classify a batch of pre-processed documents with one sparse
+    # matrix-vector product per class.
+    # Return array of labels, 1 (positive) or -1 (negative), and
+    # array of per-class log10 scores, one row per document
+    def classifyDocs(self,docs):
+        self.refresh()
+        with timed('classify',len(docs)) as timer:
+            X = self.docTermMatrix(docs)
+            timer.tokens = X.nnz
+            return self.classifyMatrix(X)
+
+    # Classify the documents of a sparse document-term count matrix
+    # over the model's term IDs, see classifyDocs
+    def classifyMatrix(self,X):
+        scores = np.empty((X.shape[0],2))
+        for c in (NEGATIVE,POSITIVE):
+            scores[:,c] = X.dot(self.logProb[c]) + self.priors[c]
+        labels = np.where(scores[:,POSITIVE] > scores[:,NEGATIVE],1,-1)
+        return labels,scores
+
+    # Classify pre-processed word list as positive (1) or negative (-1)
+    def classifyWords(self,words):
+        labels, scores = self.classifyDocs([words])
+        return int(labels[0])
+
+    # Save the model to filename, see writeModelFile for the layout.
+    # The file is written alongside and renamed into place, so a
+    # loaded model can be saved back over its own file.
+    def save(self,filename):
+        self.refresh()
+        with timed('save'):
+            self.write(filename)
+
+    # Write the model to filename, see save
+    def write(self,filename):
+        header = {'parameters': self.parameters,
+                  'stopWords': sorted(self.stopWords),
+                  'priors': self.priors,
+                  'docCounts': self.docCounts,
+                  'vocabSize': self.vocabSize,
+                  'reduceCount': self.reduceCount,
+                  'selection': self.selection}
+        arrays = self.termIds.termArrays() + [('counts',self.termCounts()),
+                                              ('logProb',self.logProb)]
+        writeModelFile(filename+'.tmp',header,arrays)
+        if os.name == 'nt' and os.path.exists(filename):
+            os.remove(filename)
+        os.rename(filename+'.tmp',filename)
+
+    # Return model memory-mapped from filename. The vocabulary
+    # is searched in place so nothing needs loading.
+    @classmethod
+    def load(cls,filename):
+        with timed('load'):
+            header, arrays = readModelFile(filename)
+        model = cls()
+        model.termIds = ExtendedVocabulary(MappedVocabulary(arrays))
+        model.counts = arrays['counts']
+        model.logProb = arrays['logProb']
+        model.priors = header['priors']
+        model.docCounts = header['docCounts']
+        model.vocabSize = header['vocabSize']
+        model.reduceCount = header['reduceCount']
+        model.selection = str(header.get('selection','frequency'))
+        model.stale = False
+        model.parameters = dict((str(k),str(v)) for k, v
+                                in header['parameters'].iteritems())
+        model.stopWords = frozenset(w.encode('utf-8') for w in header['stopWords'])
+        return model
+
+##############################################################
+#
+# Persisted model file. Layout:
+#
+#   8 byte magic, 8 byte little-endian header length,
+#   JSON header, then arrays each aligned on 8 bytes.
+#
+# The header records the class priors and document counts,
+# the vocabulary size, the [Parameters] preprocessing config and
+# stop words the model was built with, and the dtype, shape and
+# offset of each array:
+#
+#   termOffsets  int64[T+1]    start of each term in termBlob
+#   termBlob     uint8[]       vocabulary terms in ID order
+#   termIds      int64[T]      vocabulary instead, when terms are
+#                              hashed ngram IDs
+#   hashKeys     int64[T]      sorted term hashes, see termHash
+#   hashOrder    int64[T]      term ID of each of hashKeys
+#   counts       int64[2,T]    see NaiveBayesModel
+#   logProb      float64[2,T]
+#
+MODEL_MAGIC = 'NBMODEL\x03'
+MODEL_ALIGN = 8
+
+# Write header dictionary and list of (name,array) pairs to
+# the model file filename
+#
+def writeModelFile(filename,header,arrays):
+    header = dict(header)
+    header['arrays'] = {}
+    offset = 0
+    for name, a in arrays:
+        a = np.ascontiguousarray(a)
+        header['arrays'][name] = {'dtype': a.dtype.str,
+                                  'shape': list(a.shape),
+                                  'offset': offset}
+        offset += -(-a.nbytes // MODEL_ALIGN) * MODEL_ALIGN
+    text = json.dumps(header,sort_keys=True)
+    text += ' ' * (-(len(text) + 16) % MODEL_ALIGN)
+    f = open(filename,'wb')
+    f.write(MODEL_MAGIC)
+    f.write(np.array([len(text)],dtype='<u8').tostring())
+    f.write(text)
+    for name, a in arrays:
+        data = np.ascontiguousarray(a).tostring()
+        f.write(data)
+        f.write('\0' * (-len(data) % MODEL_ALIGN))
+    f.close()
+
+# Memory-map the model file filename
+# Return the header dictionary and a dictionary of read-only
+# arrays backed by the mapping (nothing is copied)
+#
+def readModelFile(filename):
+    f = open(filename,'rb')
+    try:
+        mm = mmap.mmap(f.fileno(),0,access=mmap.ACCESS_READ)
+    finally:
+        f.close()
+    if mm[:8] != MODEL_MAGIC:
+        raise ValueError(filename+" is not a Naive Bayes model file")
+    size = int(np.frombuffer(mm,dtype='<u8',count=1,offset=8)[0])
+    header = json.loads(mm[16:16+size])
+    base = 16 + size
+    arrays = {}
+    for name, spec in header['arrays'].iteritems():
+        shape = tuple(spec['shape'])
+        a = np.frombuffer(mm,dtype=spec['dtype'],
+                          count=int(np.prod(shape)),
+                          offset=base+spec['offset'])
+        arrays[name] = a.reshape(shape)
+    return header,arrays
+
+# Return the 32 bit hash a term is indexed by in a model file.
+# Hashed ngram IDs are their own hash.
+#
+def termHash(term):
+    if isinstance(term,(int,long)):
+        return term
+    return zlib.crc32(term) & 0xffffffff
+
+# Return the model file arrays holding list of terms in ID order
+#
+def termTableArrays(terms):
+    hashes = np.array([termHash(w) for w in terms],dtype=np.int64)
+    order = np.argsort(hashes,kind='mergesort')
+    hashArrays = [('hashKeys',hashes[order]),('hashOrder',order)]
+    if terms and isinstance(terms[0],(int,long)):
+        return [('termIds',np.array(terms,dtype=np.int64))] + hashArrays
+    lengths = np.fromiter((len(w) for w in terms),dtype=np.int64,
+                          count=len(terms))
+    termOffsets = np.zeros(len(terms)+1,dtype=np.int64)
+    np.cumsum(lengths,out=termOffsets[1:])
+    termBlob = np.frombuffer(''.join(terms),dtype=np.uint8)
+    return [('termOffsets',termOffsets),('termBlob',termBlob)] + hashArrays
+
+# In-memory term-to-ID map built during training
+#
+class Vocabulary(dict):
+    # Return list of IDs of terms, adding any new ones
+    def add(self,terms):
+        return [self.setdefault(w,len(self)) for w in terms]
+
+    # Return array of IDs of list of distinct terms, adding any new
+    # ones in a single update
+    def addDistinct(self,terms):
+        if not self:
+            ids = np.arange(len(terms),dtype=np.int64)
+            self.update(itertools.izip(terms,xrange(len(terms))))
+            return ids
+        ids = self.lookup(terms)
+        new = np.flatnonzero(ids < 0)
+        ids[new] = np.arange(len(self),len(self)+len(new))
+        self.update(itertools.izip([terms[k] for k in new],ids[new].tolist()))
+        return ids
+
+    # Return array of IDs of list of terms, -1 where not present
+    def lookup(self,terms):
+        return np.fromiter(itertools.imap(self.get,terms,itertools.repeat(-1)),
+                           dtype=np.int64,count=len(terms))
+
+    # Return the terms in ID order
+    def termList(self):
+        terms = [None] * len(self)
+        for w, i in self.iteritems():
+            terms[i] = w
+        return terms
+
+    # Return the model file arrays for the vocabulary
+    def termArrays(self):
+        return termTableArrays(self.termList())
+
+# Vocabulary held in a memory-mapped model file. Terms are found
+# by a vectorised binary search of their hashes in hashKeys, so
+# nothing needs loading.
+#
+class MappedVocabulary(object):
+    def __init__(self,arrays):
+        self.arrays = arrays
+        self.hashKeys = arrays['hashKeys']
+        self.hashOrder = arrays['hashOrder']
+        self.size = len(self.hashKeys)
+        if 'termIds' in arrays:
+            self.ids = arrays['termIds']
+        else:
+            self.ids = None
+            self.offsets = arrays['termOffsets']
+            self.blob = arrays['termBlob'].data
+
+    def __len__(self):
+        return self.size
+
+    # Return the term with ID i
+    def term(self,i):
+        if self.ids is not None:
+            return int(self.ids[i])
+        return self.blob[self.offsets[i]:self.offsets[i+1]]
+
+    # Return array of IDs of list of terms, -1 where not present
+    def lookup(self,terms):
+        hashes = np.array([termHash(w) for w in terms],dtype=np.int64)
+        ids = np.empty(len(terms),dtype=np.int64)
+        ids.fill(-1)
+        if self.size == 0:
+            return ids
+        pos = self.hashKeys.searchsorted(hashes)
+        found = self.hashKeys[np.minimum(pos,self.size-1)] == hashes
+        if self.ids is not None:
+            # the hash is the term
+            ids[found] = self.hashOrder[pos[found]]
+            return ids
+        # check the term itself, stepping over any hash collisions
+        for k in np.flatnonzero(found):
+            p = pos[k]
+            while p < self.size and self.hashKeys[p] == hashes[k]:
+                i = self.hashOrder[p]
+                if self.term(i) == terms[k]:
+                    ids[k] = i
+                    break
+                p += 1
+        return ids
+
+    # Return ID of term or default if not in vocabulary
+    def get(self,term,default=None):
+        i = int(self.lookup([term])[0])
+        return default if i < 0 else i
+
+    # Return the model file arrays for the vocabulary
+    def termArrays(self):
+        return [(name,self.arrays[name]) for name in
+                ('termIds','termOffsets','termBlob','hashKeys','hashOrder')
+                if name in self.arrays]
+
+# Vocabulary of a loaded model plus terms added to it since,
+# which take the IDs following those of the loaded terms (extra
+# holds them numbered from 0)
+#
+class ExtendedVocabulary(object):
+    def __init__(self,base):
+        self.base = base
+        self.extra = Vocabulary()
+
+    def __len__(self):
+        return len(self.base) + len(self.extra)
+
+    # Return array of IDs of list of terms, -1 where not present
+    def lookup(self,terms):
+        ids = self.base.lookup(terms)
+        if self.extra:
+            for k in np.flatnonzero(ids < 0):
+                i = self.extra.get(terms[k])
+                if i is not None:
+                    ids[k] = len(self.base) + i
+        return ids
+
+    # Return ID of term or default if not in vocabulary
+    def get(self,term,default=None):
+        i = int(self.lookup([term])[0])
+        return default if i < 0 else i
+
+    # Return list of IDs of terms, adding any new ones
+    def add(self,terms):
+        terms = list(terms)
+        ids = self.lookup(terms)
+        for k in np.flatnonzero(ids < 0):
+            ids[k] = len(self.base) + self.extra.setdefault(terms[k],len(self.extra))
+        return ids.tolist()
+
+    # Return array of IDs of list of distinct terms, adding any new
+    # ones
+    def addDistinct(self,terms):
+        return np.array(self.add(terms),dtype=np.int64)
+
+    # Return the model file arrays for the vocabulary. Added terms
+    # are appended to the loaded tables and merged into the hash
+    # index, so only they need hashing and sorting.
+    def termArrays(self):
+        if not self.extra:
+            return self.base.termArrays()
+        arrays = dict(self.base.termArrays())
+        newArrays = dict(termTableArrays(self.extra.termList()))
+        if 'termIds' in arrays:
+            termArrays = [('termIds',np.concatenate([arrays['termIds'],
+                                                     newArrays['termIds']]))]
+        else:
+            offsets = newArrays['termOffsets'][1:] + arrays['termOffsets'][-1]
+            termArrays = [('termOffsets',np.concatenate([arrays['termOffsets'],offsets])),
+                          ('termBlob',np.concatenate([arrays['termBlob'],
+                                                      newArrays['termBlob']]))]
+        positions = arrays['hashKeys'].searchsorted(newArrays['hashKeys'])
+        hashKeys = np.insert(arrays['hashKeys'],positions,newArrays['hashKeys'])
+        hashOrder = np.insert(arrays['hashOrder'],positions,
+                              newArrays['hashOrder'] + len(self.base))
+        return termArrays + [('hashKeys',hashKeys),('hashOrder',hashOrder)]
+
+# Set the config Parameters section to exactly parameters, a dict
+# of option name to value, adding the section if there is none
+#
+def setParameters(parameters):
+    global preprocessor
+    if not config.has_section('Parameters'):
+        config.add_section('Parameters')
+    for option in config.options('Parameters'):
+        if option not in parameters:
+            config.remove_option('Parameters',option)
+    for option, value in parameters.iteritems():
+        config.set('Parameters',option,value)
+    preprocessor = None
+
+# Switch the preprocessing config over to the parameters and
+# stop words a loaded model was built with. Options the model does
+# not list (added since it was built) are dropped, so they take
+# their defaults as in its training, and no config file is needed.
+#
+def useModelParameters(model):
+    if config.has_section('Parameters'):
+        for option in config.options('Parameters'):
+            if option not in model.parameters:
+                print "Ignoring config's", option, "(not set in model)"
+    for option, value in model.parameters.iteritems():
+        if (not config.has_option('Parameters',option) or
+                config.get('Parameters',option) != value):
+            print "Using model's", option, "=", value
+    setParameters(model.parameters)
+    setStopWords(model.stopWords)
+
+##############################################################
+#
+# Parameter sweep. Every combination of a grid of Parameters
+# settings is scored by stratified k-fold cross-validation on the
+# training documents. The grid is read from the config Sweep
+# section, one option per line with comma separated values, e.g.
+#
+#   [Sweep]
+#   Negation: False,True
+#   NgramSize: 1,2,3
+#
+# and/or given as sweep -p Option=Value,Value. Options not swept
+# keep their Parameters setting.
+#
+# The documents are read once. Configs running the same
+# preprocessing stages (see compileStages) form one task for the
+# worker processes and share one document-term matrix, e.g. those
+# differing only in ReduceFeature. Tasks are ordered by their
+# stages and a worker keeps each stage output of its last task,
+# so configs sharing leading stages, e.g. differing only in
+# NgramSize, reuse them. Each fold is trained on the class totals
+# less the fold's counts, so no document is counted twice.
+#
+SWEEP_OPTIONS = BOOLEAN_PARAMETERS + INTEGER_PARAMETERS + sorted(OPTIONAL_PARAMETERS)
+
+# Return the option from SWEEP_OPTIONS named name in any case
+#
+def sweepOption(name):
+    for option in SWEEP_OPTIONS:
+        if option.lower() == name.strip().lower():
+            return option
+    raise ValueError("Unknown sweep option: "+name)
+
+# Read the sweep grid from the config Sweep section, overridden
+# by list of "Option=Value,Value" strings
+# Return list of (option, list of value strings)
+#
+def readSweepGrid(overrides):
+    grid = []
+    settings = []
+    if config.has_section('Sweep'):
+        settings = config.items('Sweep')
+    settings += [setting.split('=',1) for setting in overrides]
+    for name, values in settings:
+        option = sweepOption(name)
+        values = [v.strip() for v in values.split(',') if v.strip()]
+        grid = [(o,v) for o, v in grid if o != option] + [(option,values)]
+    return grid
+
+# Return list of (settings, params) for each combination of
+# grid values, where settings is the tuple of values and params
+# the preprocessing options (see readParameters)
+#
+def sweepConfigs(grid):
+    options = [option for option, values in grid]
+    configs = []
+    for settings in itertools.product(*[values for option, values in grid]):
+        cfg = ConfigParser.ConfigParser()
+        cfg.add_section('Parameters')
+        for option, value in config.items('Parameters'):
+            cfg.set('Parameters',option,value)
+        # a default taken from a swept option follows it
+        for option, source in DEFAULT_FROM.iteritems():
+            if source in options and option not in options:
+                cfg.remove_option('Parameters',option)
+        for option, value in zip(options,settings):
+            cfg.set('Parameters',option,value)
+        configs.append((settings,readParameters(cfg)))
+    return configs
+
+# Read the training documents into sweepDocs, each assigned to one
+# of k folds, class by class in a random order given by seed
+#
+def readSweepDocs(k,seed,partOfSpeech):
+    global sweepDocs
+    random = np.random.RandomState(seed)
+    classes = []
+    folds = []
+    tokens = []
+    posTokens = [] if partOfSpeech else None
+    pool = startTagPool(partOfSpeech)
+    try:
+        for c, option in ((NEGATIVE,'NegativeTrainDir'),(POSITIVE,'PositiveTrainDir')):
+            start = len(classes)
+            for docs in chunks(readCorpus(config.get('Data',option)),SHARD_SIZE):
+                docs = loadDocuments(docs)
+                classes.extend([c] * len(docs))
+                tokens.extend(contents.split() for name, stamp, contents in docs)
+                if partOfSpeech:
+                    posTokens.extend(posWords(docs,pool))
+            n = len(classes) - start
+            folds.extend(random.permutation(n) % k)
+    finally:
+        stopTagPool(pool)
+    sweepDocs = {'classes': np.array(classes),
+                 'folds': np.array(folds),
+                 'k': k,
+                 'tokens': tokens,
+                 'posTokens': posTokens}
+
+# Initialise a sweep worker process with the stop words and
+# documents read by the parent
+#
+def initSweepWorker(words,docs):
+    global sweepDocs
+    setStopWords(words)
+    sweepDocs = docs
+
+# Return the documents pre-processed by list of stages, starting
+# from the part of speech filtered or all words and reusing the
+# stage outputs of the last task
+# Return the documents and the new stage outputs to keep
+#
+def sweepFeatures(partOfSpeech,stages):
+    if partOfSpeech:
+        key = ('partOfSpeech',)
+        docs = sweepDocs['posTokens']
+    else:
+        key = ('split',)
+        docs = sweepDocs['tokens']
+    memo = {}
+    for stageKey, stage in stages:
+        key += (stageKey,)
+        if key in sweepMemo:
+            docs = sweepMemo[key]
+        else:
+            docs = [list(stage(words)) for words in docs]
+        memo[key] = docs
+    return docs,memo
+
+# Build a sparse document-term count matrix of pre-processed
+# documents, adding their words to vocabulary vocab
+# Return the indices and indptr of the CSR matrix
+#
+def sweepIndices(docs,vocab):
+    indices = array.array('l')
+    indptr = array.array('l',[0])
+    for words in docs:
+        indices.extend(vocab.add(words))
+        indptr.append(len(indices))
+    return np.frombuffer(indices,dtype=np.int_),np.frombuffer(indptr,dtype=np.int_)
+
+# Cross-validate a list of (index, params) configs which share
+# their preprocessing stages
+# Return list of (index, accuracy, stdev, features, prepSeconds,
+# cvSeconds) for each config, accuracy being the mean over folds
+#
+def sweepTask(configs):
+    global sweepMemo
+    started = time.time()
+    params = configs[0][1]
+    stages = compileStages(params,stopWords)
+    docs, sweepMemo = sweepFeatures(params['PartOfSpeech'],stages)
+
+    vocab = Vocabulary()
+    indices, indptr = sweepIndices(docs,vocab)
+    X = scipy.sparse.csr_matrix((np.ones(len(indices),dtype=np.int64),indices,indptr),
+                                shape=(len(docs),len(vocab)))
+    classes = sweepDocs['classes']
+    folds = sweepDocs['folds']
+    expected = np.array(CLASS_LABELS)[classes]
+    totals = np.vstack([np.asarray(X[classes == c].sum(axis=0)).ravel()
+                        for c in (NEGATIVE,POSITIVE)])
+    prepSeconds = time.time() - started
+
+    k = sweepDocs['k']
+    accuracy = np.zeros((len(configs),k))
+    features = np.zeros((len(configs),k))
+    seconds = np.zeros(len(configs))
+    for f in range(k):
+        inFold = folds == f
+        foldCounts = np.vstack([np.asarray(X[inFold & (classes == c)].sum(axis=0)).ravel()
+                                for c in (NEGATIVE,POSITIVE)])
+        test = X[inFold]
+        for i, (index, params) in enumerate(configs):
+            started = time.time()
+            model = NaiveBayesModel()
+            model.termIds = vocab
+            model.counts = totals - foldCounts
+            model.docCounts = [int(np.count_nonzero(~inFold & (classes == c)))
+                               for c in (NEGATIVE,POSITIVE)]
+            if params['ReduceFeature'] == True:
+                features[i,f] = model.computeProbabilities(params['ReduceFeatureCount'],
+                                                           params['FeatureSelection'])
+            else:
+                features[i,f] = model.computeProbabilities()
+            labels, scores = model.classifyMatrix(test)
+            accuracy[i,f] = 100.0*np.count_nonzero(labels == expected[inFold])/len(labels)
+            seconds[i] += time.time() - started
+    return [(index,accuracy[i].mean(),accuracy[i].std(),features[i].mean(),
+             prepSeconds,seconds[i]) for i, (index, params) in enumerate(configs)]
+
+# Group list of (settings, params) configs into sweep tasks,
+# ordered by their preprocessing stages
+# Return list of tasks, each a list of (index, params)
+#
+def sweepTasks(configs):
+    groups = {}
+    for index, (settings, params) in enumerate(configs):
+        stages = compileStages(params,stopWords)
+        key = (tuple(stageKey for stageKey, stage in stages),params['PartOfSpeech'])
+        groups.setdefault(key,[]).append((index,params))
+    return [groups[key] for key in sorted(groups)]
+
+##############################################################
+#
+# Classification service. A saved model is loaded once and
+# requests are read as JSON lines, each either a string or an
+# object {"id": ..., "text": "..."}, from stdin or from any number
+# of clients of a local TCP or Unix socket. Each gets one JSON line
+# back, in order:
+#
+#   {"id": ..., "label": 1, "scores": {"negative": -311.9,
+#                                      "positive": -315.8}}
+#
+# or {"id": ..., "error": "..."}. Requests from all clients go on
+# one queue; a scoring thread takes them in batches of up to
+# batchSize, waiting at most batchWait seconds for a batch to
+# fill, and classifies each batch with one matrix product (see
+# NaiveBayesModel.classifyDocs). The model file is checked every
+# reloadInterval seconds and reloaded between batches when it
+# changes, so no request is dropped or scored by a half-loaded
+# model. Save new models with train or update, which replace the
+# file in one rename.
+#
+
+# A request waiting for its response
+#
+class PendingRequest(object):
+    def __init__(self,requestId,text):
+        self.id = requestId
+        self.text = text
+        self.response = None
+        self.done = threading.Event()
+
+    # Set the response to the request
+    def finish(self,response):
+        self.response = response
+        self.done.set()
+
+    # Wait for and return the response
+    def wait(self):
+        self.done.wait()
+        return self.response
+
+class ClassifierService(object):
+    # Marks a reload check in the request queue
+    RELOAD = object()
+
+    def __init__(self,modelFile,batchSize,batchWait,reloadInterval):
+        self.modelFile = modelFile
+        self.batchSize = batchSize
+        self.batchWait = batchWait
+        self.reloadInterval = reloadInterval
+        self.queue = Queue.Queue()
+        self.pool = None
+        self.load()
+        for target in (self.score,self.tick):
+            thread = threading.Thread(target=target)
+            thread.daemon = True
+            thread.start()
+
+    # Load the model file and switch to its parameters
+    def load(self):
+        stamp = fileStamp(self.modelFile)
+        model = NaiveBayesModel.load(self.modelFile)
+        useModelParameters(model)
+        model.refresh()
+        stopTagPool(self.pool)
+        self.pool = startTagPool(getPreprocessor().params['PartOfSpeech'])
+        self.model = model
+        self.stamp = stamp
+        log("Serving "+self.modelFile+" ("+str(model.docCounts[NEGATIVE])+" negative, "+
+            str(model.docCounts[POSITIVE])+" positive docs, "+str(model.vocabSize)+" words)")
+
+    # Reload the model if its file has changed, keeping the current
+    # model if the new one can't be loaded
+    def reloadIfChanged(self):
+        try:
+            if fileStamp(self.modelFile) != self.stamp:
+                self.load()
+        except (IOError,OSError,ValueError) as e:
+            log("Model not reloaded: "+str(e))
+
+    # Queue a request
+    # Return the PendingRequest
+    def submit(self,requestId,text):
+        request = PendingRequest(requestId,text)
+        self.queue.put(request)
+        return request
+
+    # Thread queueing a reload check every reloadInterval seconds,
+    # so the scoring thread can block on the queue
+    def tick(self):
+        while True:
+            time.sleep(self.reloadInterval)
+            self.queue.put(self.RELOAD)
+
+    # Scoring thread: classify the queued requests in batches
+    def score(self):
+        while True:
+            batch = [self.queue.get()]
+            deadline = time.time() + self.batchWait
+            while len(batch) < self.batchSize:
+                remaining = deadline - time.time()
+                try:
+                    if remaining > 0:
+                        batch.append(self.queue.get(True,remaining))
+                    else:
+                        batch.append(self.queue.get_nowait())
+                except Queue.Empty:
+                    break
+            requests = [r for r in batch if r is not self.RELOAD]
+            if len(requests) < len(batch):
+                self.reloadIfChanged()
+            if requests:
+                self.classify(requests)
+
+    # Classify a batch of requests and answer them
+    def classify(self,requests):
+        try:
+            docs = [(None,None,r.text) for r in requests]
+            labels, scores = self.model.classifyDocs(documentWords(docs,self.pool))
+            for i, r in enumerate(requests):
+                r.finish({'id': r.id,
+                          'label': int(labels[i]),
+                          'scores': {'negative': float(scores[i,NEGATIVE]),
+                                     'positive': float(scores[i,POSITIVE])}})
+        except Exception as e:
+            for r in requests:
+                if not r.done.is_set():
+                    r.finish({'id': r.id,'error': str(e)})
+
+# Print a message of the service to stderr, keeping stdout for
+# responses
+#
+def log(message):
+    sys.stderr.write(message+'\n')
+    sys.stderr.flush()
+
+# Parse a request line
+# Return tuple of (id, text) or (id, None) and an error message
+#
+def parseRequest(line):
+    try:
+        message = json.loads(line)
+    except ValueError:
+        return None,None,"request is not valid JSON"
+    requestId = None
+    if isinstance(message,dict):
+        requestId = message.get('id')
+        message = message.get('text')
+    if isinstance(message,unicode):
+        message = message.encode('utf-8')
+    if not isinstance(message,str):
+        return requestId,None,"request has no text"
+    return requestId,message,None
+
+# Answer the request lines read from rfile with response lines
+# written to wfile, in order. Requests are queued as they are read
+# and answered by a writer thread, so a client can send many
+# without waiting and have them batched.
+#
+def serveStream(service,rfile,wfile):
+    pending = Queue.Queue()
+    def write():
+        while True:
+            request = pending.get()
+            if request is None:
+                break
+            try:
+                wfile.write(json.dumps(request.wait())+'\n')
+                wfile.flush()
+            except (IOError,socket.error):
+                # client went away; keep draining its requests
+                pass
+    writer = threading.Thread(target=write)
+    writer.start()
+    try:
+        for line in iter(rfile.readline,''):
+            if not line.strip():
+                continue
+            requestId, text, error = parseRequest(line)
+            if error is None:
+                pending.put(service.submit(requestId,text))
+            else:
+                request = PendingRequest(requestId,None)
+                request.finish({'id': requestId,'error': error})
+                pending.put(request)
+    finally:
+        pending.put(None)
+        writer.join()
+
+# Socket connection handler, see serveStream
+#
+class ServiceHandler(SocketServer.StreamRequestHandler):
+    def handle(self):
+        serveStream(self.server.service,self.rfile,self.wfile)
+
+class ThreadingTCPService(SocketServer.ThreadingMixIn,SocketServer.TCPServer):
+    daemon_threads = True
+    allow_reuse_address = True
+
+if hasattr(SocketServer,'UnixStreamServer'):
+    class ThreadingUnixService(SocketServer.ThreadingMixIn,SocketServer.UnixStreamServer):
+        daemon_threads = True
+
+##############################################################
+
 def printConfigParameters(config):
     print "======================================"
     print " Naive Bayes Configuration Parameters"
@@ -205,85 +2183,263 @@ def printConfigParameters(config):
         for option in config.options(section):
             print " ", option, "=", config.get(section, option)
     print "======================================"
-    
-def main(): 
-    printConfigParameters(config)        
-    stopWords = getStopWords() 
-    
-    vocab = set()    
-    positiveWordCounts = {}
-    negativeWordCounts = {}
-    pathNegativeReviews = config.get('Data', 'NegativeTrainDir')
-    pathPositiveReviews = config.get('Data', 'PositiveTrainDir')
-
-    # Build word frequency dictionaries and vocabulary
-    #   
-    classNegativeDocCount = trainNB(pathNegativeReviews,vocab,negativeWordCounts)                                  
-    classPositiveDocCount = trainNB(pathPositiveReviews,vocab,positiveWordCounts)         
-    
-    # get list of keys in vocab not in positiveWordCounts
-    ps = set(positiveWordCounts)
-    notInPs = vocab - ps
-    
-    # add this list as keys with zero counts into positiveWordCounts
-    for w in notInPs:
-        positiveWordCounts[w] = 0
-        
-    # do the same for negativeWordCounts
-    ns = set(negativeWordCounts)   
-    notInNs = vocab - ns
-    for w in notInNs:
-        negativeWordCounts[w] = 0 
-
-    if config.getboolean('Parameters','ReduceFeature') == True: 
-        n = config.getint('Parameters','ReduceFeatureCount')
-        positiveWordCounts = reduceW(positiveWordCounts,n)
-        negativeWordCounts = reduceW(negativeWordCounts,n)
-    print "Feature size:",len(positiveWordCounts)
-         
-    # Caculate the probabilities for each word given both classes
-    # and calculate the standalone probability for each class:
-    #
-    # for each word, w in docs of class Ci:
-    #   P(w|Ci) = count(w,Ci) + 1 / count(Ci) + |vocab|    
-    # for each class Ci: 
-    #   P(Ci) = |docs of class Ci| / | total docs |
-    #
-    pDenom = sum(positiveWordCounts.values()) + len(vocab)
-    nDenom = sum(negativeWordCounts.values()) + len(vocab) 
-    probWordForPositive = {}
-    probWordForNegative = {} 
-    for w in vocab:
-        if (w in positiveWordCounts):
-            probWordForPositive[w] = math.log10((positiveWordCounts[w] + 1.0) / pDenom)
-        if (w in negativeWordCounts):
-            probWordForNegative[w] = math.log10((negativeWordCounts[w] + 1.0) / nDenom)                                 
-    
-    # Calculate the stand alone probabilities 
-    probPositive = math.log10(float(classPositiveDocCount) / (classPositiveDocCount
-                        + classNegativeDocCount))   
-    probNegative = math.log10(float(classNegativeDocCount) / (classPositiveDocCount
-                        + classNegativeDocCount)) 
 
-    # Do classification on test data
-    #
+# Return the model file name set in the config file
+#
+def getModelFile():
+    if config.has_option('Runtime','ModelFile'):
+        return config.get('Runtime','ModelFile')
+    return 'bayes-model.nbm'
+
+# Build the term counts from the training directories and
+# calculate the word probabilities
+# Return the trained model
+#
+def trainModel():
+    model = NaiveBayesModel()
+    workers = getWorkerCount()
+
+    trainNB(config.get('Data', 'NegativeTrainDir'),model,NEGATIVE,workers)
+    trainNB(config.get('Data', 'PositiveTrainDir'),model,POSITIVE,workers)
+
+    params = getPreprocessor().params
+    with timed('probabilities'):
+        if params['ReduceFeature'] == True:
+            featureCount = model.computeProbabilities(params['ReduceFeatureCount'],
+                                                      params['FeatureSelection'])
+        else:
+            featureCount = model.computeProbabilities()
+    print "Feature size:",featureCount
+
+    model.parameters = dict(config.items('Parameters'))
+    model.stopWords = stopWords
+    return model
+
+# Classify the test directories set in the config file with
+# the model and print the results
+#
+def evaluate(model):
     pathNegativeReviews = config.get('Data', 'NegativeTestDir')
-    nTestNegativeDocs, classifiedNegative = doClassification(pathNegativeReviews,-1,
-                                                 probWordForPositive,probPositive,
-                                                 probWordForNegative,probNegative)
-                     
+    nTestNegativeDocs, classifiedNegative = doClassification(pathNegativeReviews,-1,model)
+
     pathPositiveReviews = config.get('Data', 'PositiveTestDir')
-    nTestPositiveDocs, classifiedPositive = doClassification(pathPositiveReviews,1,
-                                                 probWordForPositive,probPositive,
-                                                 probWordForNegative,probNegative)
-    
+    nTestPositiveDocs, classifiedPositive = doClassification(pathPositiveReviews,1,model)
+
     # Print the results
     #
     print("Correctly predicted "+str(classifiedNegative)+" docs out of "
-        +str(nTestNegativeDocs)+" negative docs")      
+        +str(nTestNegativeDocs)+" negative docs")
     print("Correctly predicted "+str(classifiedPositive)+" docs out of "
         +str(nTestPositiveDocs)+" positive docs")
     print("Accuracy: "+str(100.0*(classifiedPositive+classifiedNegative)/
-                        (nTestPositiveDocs+nTestNegativeDocs)))+"%"                  
-                        
-main()
\ No newline at end of file
+                        (nTestPositiveDocs+nTestNegativeDocs)))+"%"
+
+# Train on the training directories and classify the test
+# directories in one run
+#
+def main():
+    printConfigParameters(config)
+    getStopWords()
+    model = trainModel()
+
+    # Do classification on test data
+    #
+    evaluate(model)
+    trimTokenCache()
+    writeProfile('main')
+
+# "train" entry point: train on the training directories and
+# save the model to modelFile
+#
+def trainMain(modelFile):
+    printConfigParameters(config)
+    getStopWords()
+    model = trainModel()
+    model.save(modelFile)
+    print "Model saved to",modelFile
+    trimTokenCache()
+    writeProfile('train')
+
+# "classify" entry point: memory-map the model in modelFile and
+# classify the documents at each of the corpus locations in dirs,
+# or the configured test directories if none given
+#
+def classifyMain(modelFile,dirs):
+    model = NaiveBayesModel.load(modelFile)
+    useModelParameters(model)
+    if not dirs:
+        evaluate(model)
+    for dirPath in dirs:
+        names, labels, scores = classifyCorpus(dirPath,model)
+        for i in range(len(names)):
+            print names[i], labels[i], scores[i,NEGATIVE], scores[i,POSITIVE]
+    trimTokenCache()
+    writeProfile('classify')
+
+# "update" entry point: load the model in modelFile, add the
+# documents in the add directories and remove those in the remove
+# directories of each class, then save it to outFile
+#
+def updateMain(modelFile,outFile,addNegative,addPositive,
+               removeNegative,removePositive):
+    model = NaiveBayesModel.load(modelFile)
+    useModelParameters(model)
+    workers = getWorkerCount()
+    for path in addNegative:
+        print "Added",trainNB(path,model,NEGATIVE,workers),"negative docs from",path
+    for path in addPositive:
+        print "Added",trainNB(path,model,POSITIVE,workers),"positive docs from",path
+    for path in removeNegative:
+        print "Removed",untrainNB(path,model,NEGATIVE),"negative docs in",path
+    for path in removePositive:
+        print "Removed",untrainNB(path,model,POSITIVE),"positive docs in",path
+    model.save(outFile)
+    print "Model saved to",outFile,"(",model.docCounts[NEGATIVE],"negative,", \
+        model.docCounts[POSITIVE],"positive docs,",model.vocabSize,"words )"
+    trimTokenCache()
+    writeProfile('update')
+
+# "sweep" entry point: cross-validate each config of the sweep
+# grid (see readSweepGrid) with k folds, printing a table of the
+# results and writing it to CSV file outFile
+#
+def sweepMain(k,overrides,outFile,seed):
+    started = time.time()
+    grid = readSweepGrid(overrides)
+    getStopWords()
+    configs = sweepConfigs(grid)
+    partOfSpeech = any(params['PartOfSpeech'] for settings, params in configs)
+    readSweepDocs(k,seed,partOfSpeech)
+    tasks = sweepTasks(configs)
+    print "Sweeping",len(configs),"configs in",len(tasks),"preprocessing groups,", \
+        k,"folds of",len(sweepDocs['classes']),"docs"
+
+    workers = min(getWorkerCount(),len(tasks))
+    if workers <= 1:
+        results = itertools.imap(sweepTask,tasks)
+        pool = None
+    else:
+        pool = multiprocessing.Pool(workers,initSweepWorker,(stopWords,sweepDocs))
+        # contiguous runs of tasks go to the same worker so they
+        # can share stage outputs
+        chunk = max(1,len(tasks) // (2*workers))
+        results = pool.imap(sweepTask,tasks,chunk)
+
+    header = [option for option, values in grid] + \
+             ['Accuracy','Stdev','Features','PrepSeconds','CVSeconds']
+    rows = [None] * len(configs)
+    print "\t".join(header)
+    try:
+        for taskResults in results:
+            for index, accuracy, stdev, features, prep, cv in taskResults:
+                rows[index] = list(configs[index][0]) + ["%.2f" % accuracy,"%.2f" % stdev,
+                                                         "%d" % features,"%.2f" % prep,
+                                                         "%.2f" % cv]
+                print "\t".join(rows[index])
+    finally:
+        if pool is not None:
+            pool.close()
+            pool.join()
+
+    f = open(outFile,'wb')
+    writer = csv.writer(f)
+    writer.writerow(header)
+    writer.writerows(rows)
+    f.close()
+    print "Swept",len(configs),"configs in %.1fs," % (time.time() - started), \
+        "results written to",outFile
+    writeProfile('sweep')
+
+# "serve" entry point: serve classification requests with the
+# model in modelFile on stdin/stdout, or on the local TCP port or
+# Unix socket path if given, until end of input or interrupted
+#
+def serveMain(modelFile,port,socketPath,batchSize,batchWait,reloadInterval):
+    service = ClassifierService(modelFile,batchSize,batchWait,reloadInterval)
+    if port is None and socketPath is None:
+        serveStream(service,sys.stdin,sys.stdout)
+        return
+    if port is not None:
+        server = ThreadingTCPService(('127.0.0.1',port),ServiceHandler)
+        log("Listening on 127.0.0.1:"+str(server.server_address[1]))
+    else:
+        if not hasattr(SocketServer,'UnixStreamServer'):
+            raise SystemExit("Unix sockets are not supported here, use --port")
+        if os.path.exists(socketPath):
+            os.remove(socketPath)
+        server = ThreadingUnixService(socketPath,ServiceHandler)
+        log("Listening on "+socketPath)
+    server.service = service
+    # shut down cleanly when killed too
+    signal.signal(signal.SIGTERM,lambda signum, frame: sys.exit(0))
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        if socketPath is not None and os.path.exists(socketPath):
+            os.remove(socketPath)
+
+def parseArgs():
+    parser = argparse.ArgumentParser(description="Naive Bayes sentiment classifier. "
+                    "With no command, train and classify the configured test data.")
+    commands = parser.add_subparsers(dest='command')
+    p = commands.add_parser('train',help="train and save the model")
+    p.add_argument('-m','--model',default=getModelFile(),help="model file to write")
+    p = commands.add_parser('classify',help="classify with a saved model")
+    p.add_argument('-m','--model',default=getModelFile(),help="model file to read")
+    p.add_argument('dirs',nargs='*',help="directories, archives or packed files of documents to classify")
+    p = commands.add_parser('update',help="add/remove documents to/from a saved model")
+    p.add_argument('-m','--model',default=getModelFile(),help="model file to update")
+    p.add_argument('-o','--output',help="model file to write (default: update in place)")
+    p.add_argument('--add-neg',action='append',default=[],metavar='DIR',
+                   help="directory, archive or packed file of new negative documents")
+    p.add_argument('--add-pos',action='append',default=[],metavar='DIR',
+                   help="directory, archive or packed file of new positive documents")
+    p.add_argument('--remove-neg',action='append',default=[],metavar='DIR',
+                   help="directory, archive or packed file of retracted negative documents")
+    p.add_argument('--remove-pos',action='append',default=[],metavar='DIR',
+                   help="directory, archive or packed file of retracted positive documents")
+    p = commands.add_parser('sweep',help="cross-validate a grid of parameter settings")
+    p.add_argument('-k','--folds',type=int,default=5,help="number of folds (default: 5)")
+    p.add_argument('-p','--param',action='append',default=[],metavar='OPTION=VALUES',
+                   help="comma separated values of a Parameters option, "
+                        "added to the config Sweep section")
+    p.add_argument('-o','--output',default='sweep-results.csv',
+                   help="CSV file of results (default: sweep-results.csv)")
+    p.add_argument('--seed',type=int,default=0,help="seed of the fold assignment")
+    p = commands.add_parser('serve',help="serve classification requests with a saved model")
+    p.add_argument('-m','--model',default=getModelFile(),help="model file to serve")
+    where = p.add_mutually_exclusive_group()
+    where.add_argument('--port',type=int,help="listen on this local TCP port "
+                       "(default: read stdin, write stdout)")
+    where.add_argument('--socket',help="listen on this Unix socket path")
+    p.add_argument('--batch-size',type=int,default=64,help="most requests scored at once")
+    p.add_argument('--batch-wait',type=float,default=2.0,
+                   help="milliseconds to wait for a batch to fill (default: 2)")
+    p.add_argument('--reload-interval',type=float,default=1.0,
+                   help="seconds between checks for a new model file (default: 1)")
+    return parser.parse_args()
+
+# Guard needed so worker processes can import this module
+# without re-running the whole train/classify job
+#
+if __name__ == '__main__':
+    startProfiler()
+    if len(sys.argv) == 1:
+        main()
+    else:
+        args = parseArgs()
+        if args.command == 'train':
+            trainMain(args.model)
+        elif args.command == 'classify':
+            classifyMain(args.model,args.dirs)
+        elif args.command == 'update':
+            updateMain(args.model,args.output or args.model,
+                       args.add_neg,args.add_pos,args.remove_neg,args.remove_pos)
+        elif args.command == 'sweep':
+            sweepMain(args.folds,args.param,args.output,args.seed)
+        elif args.command == 'serve':
+            serveMain(args.model,args.port,args.socket,args.batch_size,
+                      args.batch_wait/1000.0,args.reload_interval)